@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from ecc.jacobian import build_comb_table
+from shared.LRUCache import LRUCache
+
+
+class PointTableRegistry:
+    # Comb tables (see `build_comb_table`) for individual points, keyed by their
+    # affine `(x, y)` ints. Points added explicitly are pinned, all others are
+    # promoted after `threshold` lookups and evicted least recently used once
+    # more than `max_tables` are held. With window 4 a table holds 960 points,
+    # roughly 200 kB.
+    def __init__(self, threshold=32, max_tables=16, window=4, max_tracked=4096):
+        # A threshold of None turns automatic promotion off
+        self.threshold = threshold
+        self.window = window
+        self.promotions = 0
+        self.pinned = {}
+        self.tables = LRUCache(max_tables)
+        self.uses = LRUCache(max_tracked)
+
+    def __repr__(self):
+        return "PointTableRegistry(pinned={}, hot={}, promotions={})".format(
+            len(self.pinned), len(self.tables), self.promotions
+        )
+
+    def add(self, point, pin=True):
+        table = build_comb_table(point, self.window)
+        if pin:
+            self.pinned[point] = table
+        else:
+            self.tables.put(point, table)
+        return table
+
+    def discard(self, point):
+        self.pinned.pop(point, None)
+        self.tables.discard(point)
+
+    def lookup(self, point):
+        # Returns the table for `point` or None, counting the use towards
+        # promotion
+        table = self.pinned.get(point)
+        if table is not None:
+            return table
+        table = self.tables.get(point)
+        if table is not None or self.threshold is None:
+            return table
+        count = self.uses.get(point, 0) + 1
+        if count < self.threshold:
+            self.uses.put(point, count)
+            return None
+        self.promotions += 1
+        self.uses.put(point, 0)
+        return self.add(point, pin=False)
+
+
+class PointTableRegistryTest(TestCase):
+    gx = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+    gy = 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8
+
+    def test_promotion(self):
+        registry = PointTableRegistry(threshold=3, max_tables=1)
+        point = (self.gx, self.gy)
+        self.assertIsNone(registry.lookup(point))
+        self.assertIsNone(registry.lookup(point))
+        table = registry.lookup(point)
+        self.assertEqual(len(table), 64)
+        self.assertIs(registry.lookup(point), table)
+        self.assertEqual(registry.promotions, 1)
+
+    def test_pinned(self):
+        registry = PointTableRegistry(threshold=None, max_tables=1)
+        point = (self.gx, self.gy)
+        self.assertIsNone(registry.lookup(point))
+        table = registry.add(point)
+        self.assertIs(registry.lookup(point), table)
+        registry.discard(point)
+        self.assertIsNone(registry.lookup(point))
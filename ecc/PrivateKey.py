@@ -1,52 +1,100 @@
 import hmac
-import hashlib
+from os import urandom
 from random import randint
 from unittest import TestCase
 
-from ecc.S256Point import G, N
+from ecc.S256Point import G, N, schnorr_challenge
+from ecc.SchnorrSignature import SchnorrSignature
 from ecc.Signature import Signature
-from shared.utils import encode_base58_checksum
+from shared.utils import encode_base58_checksum, tagged_hash
+
+
+# RFC6979 starts from K = 0x00 * 32 and V = 0x01 * 32
+RFC6979_K = b"\x00" * 32
+RFC6979_V = b"\x01" * 32
+
+
+def rfc6979_nonces(secret_bytes, zs):
+    # Deterministic nonces for every z in `zs`. Uses the one-shot C HMAC of
+    # `hmac.digest` with the hash name, which is faster on CPython than
+    # reusing `hmac.new` states through `.copy()`.
+    digest = hmac.digest
+    prefix = RFC6979_V + b"\x00" + secret_bytes
+    nonces = []
+    for z in zs:
+        if z > N:
+            z -= N
+        z_bytes = z.to_bytes(32, "big")
+        k = digest(RFC6979_K, prefix + z_bytes, "sha256")
+        v = digest(k, RFC6979_V, "sha256")
+        k = digest(k, v + b"\x01" + secret_bytes + z_bytes, "sha256")
+        v = digest(k, v, "sha256")
+        while True:
+            v = digest(k, v, "sha256")
+            candidate = int.from_bytes(v, "big")
+            if candidate >= 1 and candidate < N:
+                nonces.append(candidate)
+                break
+            k = digest(k, v + b"\x00", "sha256")
+            v = digest(k, v, "sha256")
+    return nonces
 
 
 class PrivateKey:
     def __init__(self, secret):
         self.secret = secret
+        self.secret_bytes = secret.to_bytes(32, "big")
         self.point = secret * G
 
     def hex(self):
         return "{:x}".format(self.secret).zfill(64)
 
     def sign(self, z):
-        k = self.deterministic_k(z)
+        return self.sign_with_k(z, self.deterministic_k(z))
+
+    def sign_many(self, zs):
+        return [
+            self.sign_with_k(z, k)
+            for z, k in zip(zs, rfc6979_nonces(self.secret_bytes, zs))
+        ]
+
+    def sign_with_k(self, z, k):
         r = (k * G).x.num
-        k_inv = pow(k, N - 2, N)
+        k_inv = pow(k, -1, N)
         s = (z + r * self.secret) * k_inv % N
-        if s > N / 2:
+        if s > N // 2:
             s = N - s
         return Signature(r, s)
 
+    def sign_schnorr(self, msg, aux_rand=None):
+        # BIP340 signature of the bytes `msg`. `aux_rand` is mixed into the
+        # nonce as a side channel countermeasure and defaults to 32 fresh
+        # random bytes.
+        if aux_rand is None:
+            aux_rand = urandom(32)
+        d = self.secret
+        if self.point.y.num & 1:
+            d = N - d
+        xonly = self.point.xonly()
+        t = d ^ int.from_bytes(tagged_hash("BIP0340/aux", aux_rand), "big")
+        nonce = tagged_hash("BIP0340/nonce", t.to_bytes(32, "big") + xonly + msg)
+        k = int.from_bytes(nonce, "big") % N
+        if k == 0:
+            raise ValueError("nonce is zero, sign with other aux_rand")
+        point = k * G
+        if point.y.num & 1:
+            k = N - k
+        e = schnorr_challenge(point.x.num, xonly, msg)
+        return SchnorrSignature(point.x.num, (k + e * d) % N)
+
     def deterministic_k(self, z):
-        k = b"\x00" * 32
-        v = b"\x01" * 32
-        if z > N:
-            z -= N
-        z_bytes = z.to_bytes(32, "big")
-        secret_bytes = self.secret.to_bytes(32, "big")
-        s256 = hashlib.sha256
-        k = hmac.new(k, v + b"\x00" + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b"\x01" + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        while True:
-            v = hmac.new(k, v, s256).digest()
-            candidate = int.from_bytes(v, "big")
-            if candidate >= 1 and candidate < N:
-                return candidate
-            k = hmac.new(k, v + b"\x00", s256).digest()
-            v = hmac.new(k, v, s256).digest()
+        return rfc6979_nonces(self.secret_bytes, (z,))[0]
+
+    def deterministic_k_many(self, zs):
+        return rfc6979_nonces(self.secret_bytes, zs)
 
     def wif(self, compressed=True, testnet=False):
-        secret_bytes = self.secret.to_bytes(32, "big")
+        secret_bytes = self.secret_bytes
         if testnet:
             prefix = b"\xef"
         else:
@@ -65,6 +113,68 @@ class PrivateKeyTest(TestCase):
         sig = pk.sign(z)
         self.assertTrue(pk.point.verify(z, sig))
 
+    def test_deterministic_k(self):
+        import hashlib
+
+        # Reference RFC6979 HMAC-DRBG written out with hmac.new
+        def reference_k(secret, z):
+            secret_bytes = secret.to_bytes(32, "big")
+            z_bytes = z.to_bytes(32, "big")
+            k = hmac.new(
+                b"\x00" * 32,
+                b"\x01" * 32 + b"\x00" + secret_bytes + z_bytes,
+                hashlib.sha256,
+            ).digest()
+            v = hmac.new(k, b"\x01" * 32, hashlib.sha256).digest()
+            k = hmac.new(
+                k, v + b"\x01" + secret_bytes + z_bytes, hashlib.sha256
+            ).digest()
+            v = hmac.new(k, v, hashlib.sha256).digest()
+            return int.from_bytes(hmac.new(k, v, hashlib.sha256).digest(), "big")
+
+        pk = PrivateKey(12345)
+        zs = [1, 0xDEADBEEF, N - 1, 2 ** 255]
+        want = [reference_k(12345, z) for z in zs]
+        self.assertEqual([pk.deterministic_k(z) for z in zs], want)
+        self.assertEqual(pk.deterministic_k_many(zs), want)
+        sigs = pk.sign_many(zs)
+        for z, sig in zip(zs, sigs):
+            self.assertTrue(pk.point.verify(z, sig))
+            self.assertEqual((sig.r, sig.s), (pk.sign(z).r, pk.sign(z).s))
+
+    def test_sign_schnorr(self):
+        # BIP340 test vectors 0 to 2
+        vectors = (
+            (
+                3,
+                "00" * 32,
+                "00" * 32,
+                "e907831f80848d1069a5371b402410364bdf1c5f8307b0084c55f1ce2dca8215"
+                "25f66a4a85ea8b71e482a74f382d2ce5ebeee8fdb2172f477df4900d310536c0",
+            ),
+            (
+                0xB7E151628AED2A6ABF7158809CF4F3C762E7160F38B4DA56A784D9045190CFEF,
+                "00" * 31 + "01",
+                "243f6a8885a308d313198a2e03707344a4093822299f31d0082efa98ec4e6c89",
+                "6896bd60eeae296db48a229ff71dfe071bde413e6d43f917dc8dcf8c78de3341"
+                "8906d11ac976abccb20b091292bff4ea897efcb639ea871cfa95f6de339e4b0a",
+            ),
+            (
+                0xC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B14E5C9,
+                "c87aa53824b4d7ae2eb035a2b5bbbccc080e76cdc6d1692c4b0b62d798e6d906",
+                "7e2d58d8b3bcdf1abadec7829054f90dda9805aab56c77333024b9d0a508b75c",
+                "5831aaeed7b44bb74e5eab94ba9d4294c49bcf2a60728d8b4c200f50dd313c1b"
+                "ab745879a5ad954a72c45a91c3a51d3c7adea98d82f8481e0e1e03674a6f3fb7",
+            ),
+        )
+        for secret, aux_rand, msg, want in vectors:
+            pk = PrivateKey(secret)
+            msg = bytes.fromhex(msg)
+            sig = pk.sign_schnorr(msg, bytes.fromhex(aux_rand))
+            self.assertEqual(sig.serialize().hex(), want)
+            self.assertTrue(pk.point.verify_schnorr(msg, sig))
+            self.assertTrue(pk.point.verify_schnorr(msg, pk.sign_schnorr(msg)))
+
     def test_wif_compressed_testnet(self):
         from ecc.PrivateKey import PrivateKey
 
@@ -1,14 +1,125 @@
+from unittest import TestCase
+
 from ecc.FieldElement import FieldElement
 
 P = 2 ** 256 - 2 ** 32 - 977
 
 
 class S256Field(FieldElement):
+    # The operators below work on the raw ints with P inlined and only fall
+    # back to the generic FieldElement code (and its errors) for other types
+    __slots__ = ()
+
     def __init__(self, num, prime=None):
-        super().__init__(num=num, prime=P)
+        if num >= P or num < 0:
+            error = "Num {} not in field range 0 to {}".format(num, P - 1)
+            raise ValueError(error)
+        self.num = num
+        self.prime = P
+
+    @classmethod
+    def unchecked(cls, num):
+        # Skips the range check, `num` must already be reduced mod P
+        element = cls.__new__(cls)
+        element.num = num
+        element.prime = P
+        return element
 
     def __repr__(self):
         return "{:x}".format(self.num).zfill(64)
 
+    def __add__(self, other):
+        if other.__class__ is not S256Field:
+            return super().__add__(other)
+        return self.unchecked((self.num + other.num) % P)
+
+    def __sub__(self, other):
+        if other.__class__ is not S256Field:
+            return super().__sub__(other)
+        return self.unchecked((self.num - other.num) % P)
+
+    def __mul__(self, other):
+        if other.__class__ is not S256Field:
+            return super().__mul__(other)
+        return self.unchecked(self.num * other.num % P)
+
+    def __pow__(self, exponent):
+        return self.unchecked(pow(self.num, exponent % (P - 1), P))
+
+    def __truediv__(self, other):
+        if other.__class__ is not S256Field:
+            return super().__truediv__(other)
+        if other.num == 0:
+            raise ZeroDivisionError("division by zero in S256Field")
+        return self.unchecked(self.num * pow(other.num, -1, P) % P)
+
+    def __rmul__(self, coefficient):
+        return self.unchecked(self.num * coefficient % P)
+
+    # In-place variants for scratch values. They mutate `self`, so never use
+    # them on an element that is shared with a point or another caller.
+    def iadd(self, other):
+        self.num = (self.num + other.num) % P
+        return self
+
+    def isub(self, other):
+        self.num = (self.num - other.num) % P
+        return self
+
+    def imul(self, other):
+        self.num = self.num * other.num % P
+        return self
+
+    def isquare(self):
+        self.num = self.num * self.num % P
+        return self
+
+    def inverse(self):
+        if self.num == 0:
+            raise ZeroDivisionError("0 has no inverse in S256Field")
+        return self.unchecked(pow(self.num, -1, P))
+
     def sqrt(self):
-        return self ** ((P + 1) // 4)
+        return self.unchecked(pow(self.num, (P + 1) // 4, P))
+
+
+class S256FieldTest(TestCase):
+    def test_matches_field_element(self):
+        a_raw = 0xDEADBEEF ** 7 % P
+        b_raw = P - 12345
+        a, b = S256Field(a_raw), S256Field(b_raw)
+        generic_a, generic_b = FieldElement(a_raw, P), FieldElement(b_raw, P)
+        self.assertEqual((a + b).num, (generic_a + generic_b).num)
+        self.assertEqual((a - b).num, (generic_a - generic_b).num)
+        self.assertEqual((a * b).num, (generic_a * generic_b).num)
+        self.assertEqual((a / b).num, (generic_a / generic_b).num)
+        self.assertEqual((a ** -3).num, (generic_a ** -3).num)
+        self.assertEqual((5 * a).num, (5 * generic_a).num)
+        self.assertEqual(a.inverse() * a, S256Field(1))
+        self.assertEqual(type(a + b), S256Field)
+        self.assertEqual(a + generic_b, a + b)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            S256Field(P)
+        with self.assertRaises(ValueError):
+            S256Field(-1)
+        with self.assertRaises(TypeError):
+            S256Field(2) + FieldElement(2, 31)
+        with self.assertRaises(ZeroDivisionError):
+            S256Field(2) / S256Field(0)
+
+    def test_in_place(self):
+        a = S256Field(P - 1)
+        same = a.iadd(S256Field(2))
+        self.assertIs(same, a)
+        self.assertEqual(a, S256Field(1))
+        a.isub(S256Field(3)).imul(S256Field(2))
+        self.assertEqual(a, S256Field(P - 4))
+        a.isquare()
+        self.assertEqual(a, S256Field(16))
+
+    def test_sqrt(self):
+        a = S256Field(0xC0FFEE)
+        root = (a * a).sqrt()
+        self.assertIn(root.num, (a.num, P - a.num))
@@ -1,15 +1,100 @@
+import json
 from unittest.case import TestCase
 
+from ecc.jacobian import (
+    INFINITY,
+    batch_to_affine,
+    build_comb_table,
+    comb_mul,
+    jacobian_add,
+    jacobian_add_affine,
+    jacobian_mul,
+    jacobian_multi_mul,
+    to_affine,
+    to_jacobian,
+)
 from ecc.Point import Point
+from ecc.PointTableRegistry import PointTableRegistry
 from ecc.S256Field import S256Field, P
-from shared.utils import encode_base58_checksum, hash160
+from shared.LRUCache import LRUCache
+from shared.utils import encode_base58_checksum, hash160, hash256, tagged_hash
 
 A = 0
 B = 7
 N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+PARSE_CACHE_SIZE = 4096
+# Window (in bits) of the precomputed comb table of multiples of G
+G_TABLE_WINDOW = 8
+# GLV endomorphism: LAMBDA * (x, y) == (BETA * x, y) for every curve point
+BETA = 0x7AE96A2B657C07106E64479EAC3434E99CF0497512F58995C1396C28719501EE
+LAMBDA = 0x5363AD4CC05C30E0A5261C028812645A122E22EA20816678DF02967C1B23BD72
+# Short lattice basis (a1, b1), (a2, b2) used to split scalars around LAMBDA
+GLV_A1 = 0x3086D221A7D46BCDE86C90E49284EB15
+GLV_B1 = -0xE4437ED6010E88286F547FA90ABFE4C3
+GLV_A2 = 0x114CA50F7A8E2F3F657C1108D9D44CFD8
+GLV_B2 = 0x3086D221A7D46BCDE86C90E49284EB15
+
+
+def glv_split(coefficient):
+    # Returns (k1, k2), both about 128 bits and possibly negative, with
+    # k1 + k2 * LAMBDA == coefficient (mod N)
+    c1 = (GLV_B2 * coefficient + N // 2) // N
+    c2 = (-GLV_B1 * coefficient + N // 2) // N
+    k1 = coefficient - c1 * GLV_A1 - c2 * GLV_A2
+    k2 = -c1 * GLV_B1 - c2 * GLV_B2
+    return k1, k2
+
+
+def glv_terms(point, coefficient):
+    # Rewrites coefficient * point as two half-length terms for jacobian_multi_mul
+    x, y = point
+    k1, k2 = glv_split(coefficient)
+    terms = []
+    for k, term_x in ((k1, x), (k2, BETA * x % P)):
+        if k < 0:
+            terms.append(((term_x, P - y), -k))
+        else:
+            terms.append(((term_x, y), k))
+    return terms
+
+
+def lift_x(x):
+    # BIP340 lift_x: the affine (x, y) ints of the point with even y and the
+    # given x coordinate, or None if there is no such point
+    if x >= P:
+        return None
+    alpha = (pow(x, 3, P) + B) % P
+    y = pow(alpha, (P + 1) // 4, P)
+    if y * y % P != alpha:
+        return None
+    if y & 1:
+        return x, P - y
+    return x, y
+
+
+def schnorr_challenge(r, xonly, msg):
+    e = tagged_hash("BIP0340/challenge", r.to_bytes(32, "big") + xonly + msg)
+    return int.from_bytes(e, "big") % N
+
+
+def encode_sec(x, y, compressed=True):
+    # Returns the binary version of the SEC format
+    if compressed:
+        if y % 2 == 0:
+            return b"\x02" + x.to_bytes(32, "big")
+        else:
+            return b"\x03" + x.to_bytes(32, "big")
+    return b"\x04" + x.to_bytes(32, "big") + y.to_bytes(32, "big")
 
 
 class S256Point(Point):
+    # Opt-in: split variable-base scalars with the GLV endomorphism
+    glv = False
+    # Points decoded by `parse`, keyed by their SEC bytes
+    parse_cache = LRUCache(PARSE_CACHE_SIZE)
+    # Comb tables of pinned and frequently multiplied points
+    point_tables = PointTableRegistry()
+
     def __init__(self, x, y, a=None, b=None):
         a, b = S256Field(A), S256Field(B)
         if type(x) == int:
@@ -23,25 +108,133 @@ class S256Point(Point):
         else:
             return "S256Point({}, {})".format(self.x, self.y)
 
+    @classmethod
+    def from_jacobian(cls, point):
+        # Results of our own arithmetic are on the curve by construction,
+        # so the curve equation check of `Point.__init__` is skipped
+        affine = to_affine(point)
+        if affine is None:
+            return cls(None, None)
+        result = cls.__new__(cls)
+        result.a = CURVE_A
+        result.b = CURVE_B
+        result.x = S256Field.unchecked(affine[0])
+        result.y = S256Field.unchecked(affine[1])
+        return result
+
+    @classmethod
+    def from_jacobian_many(cls, points):
+        # Like `from_jacobian`, but with one inversion for the whole list
+        result = []
+        for affine in batch_to_affine(points):
+            if affine is None:
+                result.append(cls(None, None))
+                continue
+            point = cls.__new__(cls)
+            point.a = CURVE_A
+            point.b = CURVE_B
+            point.x = S256Field.unchecked(affine[0])
+            point.y = S256Field.unchecked(affine[1])
+            result.append(point)
+        return result
+
+    def __add__(self, other):
+        if not isinstance(other, S256Point):
+            return super().__add__(other)
+        if self.x is None:
+            return other
+        if other.x is None:
+            return self
+        total = jacobian_add_affine(
+            to_jacobian(self.x.num, self.y.num), other.x.num, other.y.num
+        )
+        return self.from_jacobian(total)
+
     def __rmul__(self, coefficient):
         coef = coefficient % N
-        return super().__rmul__(coef)
+        if self.x is None:
+            return self
+        return self.from_jacobian(multi_mul_jacobian([(coef, self)]))
+
+    def precompute(self):
+        # Pins a comb table for this point, after which multiplying it costs
+        # about as much as multiplying G
+        self.point_tables.add((self.x.num, self.y.num))
+
+    @classmethod
+    def multi_mul(cls, terms):
+        # Returns the sum of coefficient * point for all `(coefficient, point)`
+        # terms, see `multi_mul_jacobian`
+        return cls.from_jacobian(multi_mul_jacobian(terms))
 
     def verify(self, z, sig):
         s_inv = pow(sig.s, N - 2, N)
         u = z * s_inv % N
         v = sig.r * s_inv % N
-        total = u * G + v * self
+        total = self.multi_mul([(u, G), (v, self)])
+        if total.x is None:
+            return False
         return total.x.num == sig.r
 
+    def verify_schnorr(self, msg, sig):
+        # BIP340 verification against the x-only key of this point
+        if sig.r >= P or sig.s >= N or self.x is None:
+            return False
+        e = schnorr_challenge(sig.r, self.xonly(), msg)
+        # R = s * G - e * P where P is the point with even y, which is self
+        # or its negation
+        if self.y.num & 1:
+            coefficient = e
+        else:
+            coefficient = N - e
+        total = to_affine(multi_mul_jacobian([(sig.s, G), (coefficient, self)]))
+        if total is None or total[1] & 1:
+            return False
+        return total[0] == sig.r
+
+    def xonly(self):
+        # BIP340 public key, the 32 byte x coordinate
+        return self.x.num.to_bytes(32, "big")
+
+    @classmethod
+    def parse_xonly(cls, xonly_bin):
+        # Returns the point with even y for a BIP340 public key
+        if len(xonly_bin) != 32:
+            raise ValueError("x-only keys are 32 bytes")
+        return cls.parse(b"\x02" + bytes(xonly_bin))
+
     def sec(self, compressed=True):
-        # Returns the binary version of the SEC format
-        if compressed:
-            if self.y.num % 2 == 0:
-                return b"\x02" + self.x.num.to_bytes(32, "big")
+        return encode_sec(self.x.num, self.y.num, compressed)
+
+    @classmethod
+    def sec_many(cls, points, compressed=True):
+        # SEC encodings of a mix of S256Points and Jacobian `(X, Y, Z)` tuples,
+        # the tuples are all normalized with a single inversion
+        jacobian = [i for i, point in enumerate(points) if type(point) == tuple]
+        affine = dict(zip(jacobian, batch_to_affine([points[i] for i in jacobian])))
+        result = []
+        for i, point in enumerate(points):
+            if i in affine:
+                point = affine[i]
+            elif point.x is not None:
+                point = (point.x.num, point.y.num)
             else:
-                return b"\x03" + self.x.num.to_bytes(32, "big")
-        return b"\x04" + self.x.num.to_bytes(32, "big") + self.y.num.to_bytes(32, "big")
+                point = None
+            if point is None:
+                raise ValueError("The point at infinity has no SEC encoding")
+            result.append(encode_sec(point[0], point[1], compressed))
+        return result
+
+    @classmethod
+    def address_many(cls, points, compressed=True, testnet=False):
+        if testnet:
+            prefix = b"\x6f"
+        else:
+            prefix = b"\x00"
+        return [
+            encode_base58_checksum(prefix + hash160(sec))
+            for sec in cls.sec_many(points, compressed)
+        ]
 
     def hash160(self, compressed=True):
         return hash160(self.sec(compressed))
@@ -55,8 +248,18 @@ class S256Point(Point):
         return encode_base58_checksum(prefix + h160)
 
     @classmethod
-    def parse(self, sec_bin):
-        # Returns a Point from a SEC binary
+    def parse(cls, sec_bin):
+        # Returns a Point from a SEC binary. Decoded points are kept in
+        # `parse_cache`, resize it to 0 to turn caching off.
+        key = bytes(sec_bin)
+        point = cls.parse_cache.get(key)
+        if point is None:
+            point = cls.parse_uncached(key)
+            cls.parse_cache.put(key, point)
+        return point
+
+    @classmethod
+    def parse_uncached(self, sec_bin):
         if sec_bin[0] == 4:
             x = int.from_bytes(sec_bin[1:33], "big")
             y = int.from_bytes(sec_bin[33:65], "big")
@@ -76,13 +279,238 @@ class S256Point(Point):
         return S256Point(x, odd_beta)
 
 
+CURVE_A = S256Field(A)
+CURVE_B = S256Field(B)
+
 G = S256Point(
     0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
 )
 
 
+def multi_mul_jacobian(terms):
+    # Multiples of G are folded into one lookup in the generator table and
+    # points with a table in `S256Point.point_tables` use theirs, all other
+    # points share their doublings. Points may also be given as affine (x, y)
+    # ints. The result stays in Jacobian form.
+    registry = S256Point.point_tables
+    g_coef = 0
+    others = []
+    total = INFINITY
+    for coefficient, point in terms:
+        if type(point) == tuple:
+            # Affine (x, y) ints of one-off points, which skip the table
+            # lookup so they do not crowd hot points out of the registry
+            affine = point
+        elif point.x is None:
+            continue
+        elif point.x == G.x and point.y == G.y:
+            g_coef += coefficient
+            continue
+        else:
+            affine = (point.x.num, point.y.num)
+            table = registry.lookup(affine)
+            if table is not None:
+                total = jacobian_add(
+                    total, comb_mul(table, coefficient % N, registry.window)
+                )
+                continue
+        if S256Point.glv:
+            others.extend(glv_terms(affine, coefficient % N))
+        else:
+            others.append((affine, coefficient % N))
+    total = jacobian_add(total, jacobian_multi_mul(others))
+    g_coef %= N
+    if g_coef:
+        total = jacobian_add(total, comb_mul(generator_table(), g_coef, G_TABLE_WINDOW))
+    return total
+
+
+_generator_table = None
+
+
+def generator_table():
+    # Built on first use, or read from disk with `load_generator_table`
+    global _generator_table
+    if _generator_table is None:
+        _generator_table = build_comb_table((G.x.num, G.y.num), G_TABLE_WINDOW)
+    return _generator_table
+
+
+def dump_generator_table(filename):
+    points = [
+        "{:064x}{:064x}".format(x, y) for row in generator_table() for x, y in row[1:]
+    ]
+    checksum = hash256("".join(points).encode("ascii")).hex()
+    with open(filename, "w") as f:
+        s = json.dumps(
+            {"window": G_TABLE_WINDOW, "checksum": checksum, "points": points}
+        )
+        f.write(s)
+
+
+def load_generator_table(filename):
+    global _generator_table
+    disk_table = json.loads(open(filename, "r").read())
+    if disk_table["window"] != G_TABLE_WINDOW:
+        raise ValueError(
+            "generator table window {} != {}".format(
+                disk_table["window"], G_TABLE_WINDOW
+            )
+        )
+    points = disk_table["points"]
+    if hash256("".join(points).encode("ascii")).hex() != disk_table["checksum"]:
+        raise ValueError("generator table checksum mismatch")
+    row_size = (1 << G_TABLE_WINDOW) - 1
+    table = []
+    for start in range(0, len(points), row_size):
+        row = [None]
+        for point in points[start : start + row_size]:
+            row.append((int(point[:64], 16), int(point[64:], 16)))
+        table.append(row)
+    if len(table) * G_TABLE_WINDOW < 256 or table[0][1] != (G.x.num, G.y.num):
+        raise ValueError("not a generator table")
+    _generator_table = table
+
+
 class S256PointTest(TestCase):
+    def test_rmul(self):
+        for k in (1, 2, 5001, 2 ** 200 + 17, N - 1):
+            self.assertEqual(k * G, Point.__rmul__(G, k))
+        self.assertIsNone((N * G).x)
+
+    def test_multi_mul(self):
+        p1 = 0xC0FFEE * G
+        p2 = 0xDEADBEEF * G
+        terms = [(2 ** 130 + 1, G), (N - 5, p1), (12345, p2), (7, G)]
+        want = S256Point(None, None)
+        for coefficient, point in terms:
+            want += coefficient * point
+        self.assertEqual(S256Point.multi_mul(terms), want)
+        self.assertIsNone(S256Point.multi_mul([(N, p1), (0, G)]).x)
+
+    def test_glv_split(self):
+        for k in (0, 1, LAMBDA, N - 1, 2 ** 255 + 99, 0xDEADBEEF * 2 ** 128):
+            k1, k2 = glv_split(k)
+            self.assertEqual((k1 + k2 * LAMBDA) % N, k)
+            self.assertLess(abs(k1).bit_length(), 130)
+            self.assertLess(abs(k2).bit_length(), 130)
+        x, y = G.x.num, G.y.num
+        self.assertEqual(to_affine(jacobian_mul((x, y), LAMBDA)), (BETA * x % P, y))
+
+    def test_glv(self):
+        point = 0xC0FFEE * G
+        other = 0xDEADBEEF * G
+        coefficients = (1, 2, LAMBDA, N - 1, 2 ** 255 + 12345, 0xFEEDFACE)
+        want = [Point.__rmul__(point, k) for k in coefficients]
+        want_multi = S256Point.multi_mul([(7, other), (N - 3, point), (11, G)])
+        S256Point.glv = True
+        try:
+            for k, expected in zip(coefficients, want):
+                self.assertEqual(k * point, expected)
+            got_multi = S256Point.multi_mul([(7, other), (N - 3, point), (11, G)])
+            self.assertEqual(got_multi, want_multi)
+        finally:
+            S256Point.glv = False
+
+    def test_precompute(self):
+        point = 0xBADCAFE * G
+        coefficients = (1, 2 ** 255 + 3, N - 1, 0xC0FFEE)
+        want = [Point.__rmul__(point, k) for k in coefficients]
+        want_verify = S256Point.multi_mul([(5, G), (N - 9, point)])
+        point.precompute()
+        try:
+            for k, expected in zip(coefficients, want):
+                self.assertEqual(k * point, expected)
+            self.assertEqual(S256Point.multi_mul([(5, G), (N - 9, point)]), want_verify)
+        finally:
+            S256Point.point_tables.discard((point.x.num, point.y.num))
+
+    def test_hot_point_promotion(self):
+        point = 0xFACADE * G
+        key = (point.x.num, point.y.num)
+        registry = S256Point.point_tables
+        want = 7 * point
+        for _ in range(registry.threshold + 1):
+            self.assertEqual(7 * point, want)
+        self.assertIn(key, registry.tables)
+        registry.discard(key)
+
+    def test_sec_many(self):
+        secrets = [5000, 5001, 2020 ** 5, 0x12345DEADBEEF]
+        points = [multi_mul_jacobian([(secret, G)]) for secret in secrets]
+        for compressed in (True, False):
+            want = [(secret * G).sec(compressed) for secret in secrets]
+            self.assertEqual(S256Point.sec_many(points, compressed), want)
+        self.assertEqual(
+            S256Point.address_many(points[2:], testnet=True)[0],
+            "mopVkxp8UhXqRYbCYJsbeE1h1fiF64jcoH",
+        )
+        mixed = [points[0], 5001 * G]
+        self.assertEqual(
+            S256Point.sec_many(mixed), [p.sec() for p in (5000 * G, 5001 * G)]
+        )
+        self.assertEqual(S256Point.from_jacobian_many(points), [k * G for k in secrets])
+        with self.assertRaises(ValueError):
+            S256Point.sec_many([multi_mul_jacobian([(N, G)])])
+
+    def test_generator_table(self):
+        import os
+        from tempfile import TemporaryDirectory
+
+        table = generator_table()
+        for k in (1, 255, 256, 2 ** 255 + 12345, N - 1):
+            want = jacobian_mul((G.x.num, G.y.num), k)
+            got = comb_mul(table, k, G_TABLE_WINDOW)
+            self.assertEqual(to_affine(got), to_affine(want))
+        with TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "g.table")
+            dump_generator_table(filename)
+            load_generator_table(filename)
+            self.assertIsNot(generator_table(), table)
+            self.assertEqual(generator_table(), table)
+
+    def test_verify(self):
+        from ecc.Signature import Signature
+
+        point = S256Point(
+            0x887387E452B8EACC4ACFDE10D9AAF7F6D9A0F975AABB10D006E4DA568744D06C,
+            0x61DE6D95231CD89026E286DF3B6AE4A894A3378E393E93A0F45B666329A0AE34,
+        )
+        z = 0xEC208BAA0FC1C19F708A9CA96FDEFF3AC3F230BB4A7BA4AEDE4942AD003C0F60
+        r = 0xAC8D1C87E51D0D441BE8B3DD5B05C8795B48875DFFE00B7FFCFAC23010D3A395
+        s = 0x68342CEFF8935EDEDD102DD876FFD6BA72D6A427A3EDB13D26EB0781CB423C4
+        self.assertTrue(point.verify(z, Signature(r, s)))
+        self.assertFalse(point.verify(z + 1, Signature(r, s)))
+
+    def test_verify_schnorr(self):
+        from ecc.SchnorrSignature import SchnorrSignature
+
+        # BIP340 test vectors 1 and 5 to 7
+        point = S256Point.parse_xonly(
+            bytes.fromhex(
+                "dff1d77f2a671c5f36183726db2341be58feae1da2deced843240f7b502ba659"
+            )
+        )
+        msg = bytes.fromhex(
+            "243f6a8885a308d313198a2e03707344a4093822299f31d0082efa98ec4e6c89"
+        )
+        sig = SchnorrSignature.parse(
+            bytes.fromhex(
+                "6896bd60eeae296db48a229ff71dfe071bde413e6d43f917dc8dcf8c78de3341"
+                "8906d11ac976abccb20b091292bff4ea897efcb639ea871cfa95f6de339e4b0a"
+            )
+        )
+        self.assertTrue(point.verify_schnorr(msg, sig))
+        self.assertTrue((-1 * point).verify_schnorr(msg, sig))
+        self.assertFalse(point.verify_schnorr(msg[:-1] + b"\x8a", sig))
+        self.assertFalse(point.verify_schnorr(msg, SchnorrSignature(sig.r, N - sig.s)))
+        self.assertFalse(point.verify_schnorr(msg, SchnorrSignature(sig.r, sig.s + N)))
+        self.assertFalse(point.verify_schnorr(msg, SchnorrSignature(P, sig.s)))
+        self.assertIsNone(lift_x(5))
+        with self.assertRaises(ValueError):
+            S256Point.parse_xonly((5).to_bytes(32, "big"))
+
     def test_sec_uncompressed(self):
         from ecc.PrivateKey import PrivateKey
 
@@ -118,6 +546,21 @@ class S256PointTest(TestCase):
         result = S256Point.parse(sec)
         self.assertEqual(result, priv.point)
 
+    def test_parse_cache(self):
+        sec = (0xFEED * G).sec()
+        S256Point.parse_cache.clear()
+        first = S256Point.parse(sec)
+        self.assertIs(S256Point.parse(bytearray(sec)), first)
+        self.assertEqual(S256Point.parse_cache.stats()["hits"], 1)
+        self.assertEqual(S256Point.parse_cache.stats()["misses"], 1)
+        S256Point.parse_cache.resize(0)
+        try:
+            self.assertIsNot(S256Point.parse(sec), first)
+            self.assertEqual(S256Point.parse(sec), first)
+            self.assertEqual(len(S256Point.parse_cache), 0)
+        finally:
+            S256Point.parse_cache.resize(PARSE_CACHE_SIZE)
+
     def test_address_uncompressed_testnet(self):
         from ecc.PrivateKey import PrivateKey
 
@@ -0,0 +1,37 @@
+from unittest.case import TestCase
+
+
+class SchnorrSignature:
+    # BIP340 signature: the x coordinate of the nonce point R and s
+    def __init__(self, r, s):
+        self.r = r
+        self.s = s
+
+    def __repr__(self):
+        return "SchnorrSignature({:x},{:x})".format(self.r, self.s)
+
+    def serialize(self):
+        return self.r.to_bytes(32, "big") + self.s.to_bytes(32, "big")
+
+    @classmethod
+    def parse(cls, signature_bin):
+        if len(signature_bin) != 64:
+            raise SyntaxError("Bad Schnorr Signature Length")
+        r = int.from_bytes(signature_bin[:32], "big")
+        s = int.from_bytes(signature_bin[32:], "big")
+        return cls(r, s)
+
+
+class SchnorrSignatureTest(TestCase):
+    def test_serialize(self):
+        raw = bytes.fromhex(
+            "e907831f80848d1069a5371b402410364bdf1c5f8307b0084c55f1ce2dca8215"
+            "25f66a4a85ea8b71e482a74f382d2ce5ebeee8fdb2172f477df4900d310536c0"
+        )
+        sig = SchnorrSignature.parse(raw)
+        self.assertEqual(
+            sig.r, 0xE907831F80848D1069A5371B402410364BDF1C5F8307B0084C55F1CE2DCA8215
+        )
+        self.assertEqual(sig.serialize(), raw)
+        with self.assertRaises(SyntaxError):
+            SchnorrSignature.parse(raw[:63])
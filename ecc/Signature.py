@@ -1,4 +1,3 @@
-from io import BytesIO
 from unittest.case import TestCase
 
 
@@ -11,40 +10,58 @@ class Signature:
         return "Signature({:x},{:x})".format(self.r, self.s)
 
     def der(self):
-        rbin = self.r.to_bytes(32, "big")
-        rbin = rbin.lstrip(b"\x00")
-        if rbin[0] & 0x80:
-            rbin = b"\x00" + rbin
-        result = bytes([2, len(rbin)]) + rbin
-        sbin = self.s.to_bytes(32, "big")
-        sbin = sbin.lstrip(b"\x00")
-        if sbin[0] & 0x80:
-            sbin = b"\x00" + sbin
-        result += bytes([2, len(sbin)]) + sbin
-        return bytes([0x30, len(result)]) + result
+        # Lengths come from bit_length, with one spare bit for the sign so a
+        # set high bit gets a 0x00 pad, and the encoding is built in one go
+        r_length = (self.r.bit_length() + 8) // 8
+        s_length = (self.s.bit_length() + 8) // 8
+        return (
+            bytes((0x30, r_length + s_length + 4, 2, r_length))
+            + self.r.to_bytes(r_length, "big")
+            + bytes((2, s_length))
+            + self.s.to_bytes(s_length, "big")
+        )
 
     @classmethod
-    def parse(cls, signature_bin):
-        s = BytesIO(signature_bin)
-        compound = s.read(1)[0]
-        if compound != 0x30:
+    def parse(cls, signature_bin, strict=False):
+        # Reads the DER signature in place from any bytes-like object, e.g. a
+        # memoryview slice of a script. strict=True also rejects the non
+        # canonical encodings that BIP66 forbids.
+        data = signature_bin
+        size = len(data)
+        if size < 6 or data[0] != 0x30:
             raise SyntaxError("Bad Signature")
-        length = s.read(1)[0]
-        if length + 2 != len(signature_bin):
+        if data[1] + 2 != size:
             raise SyntaxError("Bad Signature Length")
-        marker = s.read(1)[0]
-        if marker != 0x02:
+        if data[2] != 0x02:
             raise SyntaxError("Bad Signature")
-        rlength = s.read(1)[0]
-        r = int.from_bytes(s.read(rlength), "big")
-        marker = s.read(1)[0]
-        if marker != 0x02:
+        s_start = 4 + data[3]
+        if s_start + 2 > size or data[s_start] != 0x02:
             raise SyntaxError("Bad Signature")
-        slength = s.read(1)[0]
-        s = int.from_bytes(s.read(slength), "big")
-        if len(signature_bin) != 6 + rlength + slength:
+        if size != s_start + 2 + data[s_start + 1]:
             raise SyntaxError("Signature too long")
-        return cls(r, s)
+        r_bin = data[4:s_start]
+        s_bin = data[s_start + 2 :]
+        if strict:
+            if size > 72:
+                raise SyntaxError("Signature too long")
+            check_der_integer(r_bin)
+            check_der_integer(s_bin)
+        return cls(int.from_bytes(r_bin, "big"), int.from_bytes(s_bin, "big"))
+
+    @classmethod
+    def parse_many(cls, signatures_bin, strict=False):
+        parse = cls.parse
+        return [parse(signature_bin, strict) for signature_bin in signatures_bin]
+
+
+def check_der_integer(integer_bin):
+    # BIP66: integers are non empty, positive and minimally encoded
+    if len(integer_bin) == 0:
+        raise SyntaxError("Bad Signature Integer Length")
+    if integer_bin[0] & 0x80:
+        raise SyntaxError("Negative Signature Integer")
+    if len(integer_bin) > 1 and integer_bin[0] == 0 and not integer_bin[1] & 0x80:
+        raise SyntaxError("Signature Integer Padding")
 
 
 class SignatureTest(TestCase):
@@ -57,3 +74,30 @@ class SignatureTest(TestCase):
             result,
             "3045022037206a0610995c58074999cb9767b87af4c4978db68c06e8e6e81d282047a7c60221008ca63759c1157ebeaec0d03cecca119fc9a75bf8e6d0fa65c841c8e2738cdaec",
         )
+
+    def test_parse(self):
+        want = bytes.fromhex(
+            "3045022037206a0610995c58074999cb9767b87af4c4978db68c06e8e6e81d282047a7c60221008ca63759c1157ebeaec0d03cecca119fc9a75bf8e6d0fa65c841c8e2738cdaec"
+        )
+        for r, s in ((1, 2), (0x80, 0x7F), (2 ** 255 + 5, 2 ** 100)):
+            der = Signature(r, s).der()
+            for sig in (Signature.parse(der), Signature.parse(der, strict=True)):
+                self.assertEqual((sig.r, sig.s), (r, s))
+        script = bytearray(b"\x00" + want + b"\x01")
+        sig = Signature.parse(memoryview(script)[1:-1], strict=True)
+        self.assertEqual(sig.der(), want)
+        sigs = Signature.parse_many([want, Signature(3, 4).der()])
+        self.assertEqual([(sig.r, sig.s) for sig in sigs[1:]], [(3, 4)])
+        for bad in (b"", want[:-1], want + b"\x00", b"\x31" + want[1:]):
+            with self.assertRaises(SyntaxError):
+                Signature.parse(bad)
+
+    def test_parse_strict(self):
+        # Accepted by the lax parser, but not BIP66 canonical
+        padded = bytes.fromhex("300702020001020105")
+        negative = bytes.fromhex("3006020181020105")
+        empty = bytes.fromhex("30050200020105")
+        for der in (padded, negative, empty):
+            Signature.parse(der)
+            with self.assertRaises(SyntaxError):
+                Signature.parse(der, strict=True)
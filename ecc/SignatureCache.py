@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+from shared.SaltedLRUCache import SaltedLRUCache
+
+
+class SignatureCache(SaltedLRUCache):
+    # Remembers `(point, z, sig)` triples that verified, so that a signature
+    # seen first in the mempool and again in a block is only checked once
+    def key(self, point, z, sig):
+        data = (
+            z.to_bytes(32, "big")
+            + point.x.num.to_bytes(32, "big")
+            + point.y.num.to_bytes(32, "big")
+            + sig.r.to_bytes(32, "big")
+            + sig.s.to_bytes(32, "big")
+        )
+        return super().key(data)
+
+    def verify(self, point, z, sig):
+        # Same result as `point.verify(z, sig)`, valid signatures are cached
+        key = self.key(point, z, sig)
+        if self.entries.get(key) is not None:
+            return True
+        if not point.verify(z, sig):
+            return False
+        self.entries.put(key, True)
+        return True
+
+
+class SignatureCacheTest(TestCase):
+    def test_verify(self):
+        from ecc.PrivateKey import PrivateKey
+        from ecc.Signature import Signature
+
+        private_key = PrivateKey(0xC0FFEE)
+        z = 0xDEADBEEF
+        sig = private_key.sign(z)
+        cache = SignatureCache(maxsize=2)
+        self.assertTrue(cache.verify(private_key.point, z, sig))
+        self.assertTrue(cache.contains(private_key.point, z, sig))
+        self.assertTrue(cache.verify(private_key.point, z, sig))
+        self.assertFalse(cache.verify(private_key.point, z + 1, sig))
+        self.assertFalse(cache.contains(private_key.point, z + 1, sig))
+        bad = Signature(sig.r, sig.s + 1)
+        self.assertFalse(cache.verify(private_key.point, z, bad))
+        self.assertEqual(cache.stats()["size"], 1)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertNotEqual(
+            SignatureCache().key(private_key.point, z, sig),
+            cache.key(private_key.point, z, sig),
+        )
@@ -0,0 +1,176 @@
+from multiprocessing import Pool
+from secrets import randbits
+from unittest import TestCase
+
+from ecc.jacobian import batch_inverse
+from ecc.S256Field import P
+from ecc.S256Point import (
+    G,
+    N,
+    generator_table,
+    lift_x,
+    load_generator_table,
+    multi_mul_jacobian,
+    schnorr_challenge,
+)
+
+# Bits of the random weights in `verify_schnorr_batch`, a forged batch passes
+# with probability 2^-SCHNORR_BATCH_WEIGHT_BITS
+SCHNORR_BATCH_WEIGHT_BITS = 128
+
+
+def verify_batch(items):
+    # Verifies many `(point, z, sig)` triples and returns one boolean per item,
+    # with the same result as `point.verify(z, sig)`.
+    # ECDSA signatures only carry the x coordinate of R, so unlike Schnorr
+    # there is no single combined equation to check. Instead the work that
+    # can be shared is: one inversion for all `s` values, the generator table
+    # for every u * G and no inversion at all per item, since the x coordinate
+    # is compared in Jacobian form (X == r * Z^2).
+    results = [False] * len(items)
+    indices = [i for i, (_, _, sig) in enumerate(items) if 0 < sig.s < N]
+    s_invs = batch_inverse([items[i][2].s for i in indices], N)
+    for i, s_inv in zip(indices, s_invs):
+        point, z, sig = items[i]
+        if not 0 < sig.r < N or point.x is None:
+            continue
+        u = z * s_inv % N
+        v = sig.r * s_inv % N
+        x, _, z_jacobian = multi_mul_jacobian([(u, G), (v, point)])
+        if z_jacobian == 0:
+            continue
+        results[i] = x == sig.r * z_jacobian * z_jacobian % P
+    return results
+
+
+def verify_schnorr_batch(items):
+    # Verifies many BIP340 `(point, msg, sig)` triples and returns one boolean
+    # per item, with the same result as `point.verify_schnorr(msg, sig)`.
+    # All well formed items are checked with one multi-scalar multiplication
+    #   (s1 + a2 s2 + ...) G - (R1 + a2 R2 + ...) - (e1 P1 + a2 e2 P2 + ...) == 0
+    # for random weights a_i, which shares the doublings of every term and
+    # merges the terms of signatures by the same key. Only if that fails are
+    # the items verified one by one to find the bad ones.
+    results = [False] * len(items)
+    indices = []
+    g_coef = 0
+    key_terms = {}
+    r_terms = []
+    for i, (point, msg, sig) in enumerate(items):
+        if sig.r >= P or sig.s >= N or point.x is None:
+            continue
+        r_point = lift_x(sig.r)
+        if r_point is None:
+            continue
+        if indices:
+            weight = randbits(SCHNORR_BATCH_WEIGHT_BITS) or 1
+        else:
+            weight = 1
+        indices.append(i)
+        e = schnorr_challenge(sig.r, point.xonly(), msg)
+        g_coef += weight * sig.s
+        r_terms.append((N - weight, r_point))
+        # Coefficients are for the even y point, which self may be the negation of
+        x = point.x.num
+        if x not in key_terms:
+            key_terms[x] = [0, point]
+        key_terms[x][0] -= weight * e
+    if not indices:
+        return results
+    terms = [(g_coef % N, G)] + r_terms
+    for coefficient, point in key_terms.values():
+        if point.y.num & 1:
+            coefficient = -coefficient
+        terms.append((coefficient % N, point))
+    if multi_mul_jacobian(terms)[2] == 0:
+        for i in indices:
+            results[i] = True
+        return results
+    for i in indices:
+        point, msg, sig = items[i]
+        results[i] = point.verify_schnorr(msg, sig)
+    return results
+
+
+def sign_batch(jobs, processes=None, verify=False, table_file=None, chunksize=64):
+    # Signs `(private_key, z)` jobs and returns the signatures in job order.
+    # With `processes` the jobs are spread over a process pool whose workers
+    # warm their generator table on start, from `table_file` if given.
+    # verify=True checks all signatures in one `verify_batch` call at the end
+    # and raises RuntimeError if any of them does not verify.
+    if processes is None:
+        sigs = [private_key.sign(z) for private_key, z in jobs]
+    else:
+        with Pool(processes, initializer=init_signer, initargs=(table_file,)) as pool:
+            sigs = pool.map(sign_job, jobs, chunksize)
+    if verify:
+        items = [(key.point, z, sig) for (key, z), sig in zip(jobs, sigs)]
+        failed = [i for i, ok in enumerate(verify_batch(items)) if not ok]
+        if failed:
+            raise RuntimeError("signatures for jobs {} do not verify".format(failed))
+    return sigs
+
+
+def init_signer(table_file):
+    if table_file is None:
+        generator_table()
+    else:
+        load_generator_table(table_file)
+
+
+def sign_job(job):
+    private_key, z = job
+    return private_key.sign(z)
+
+
+class BatchTest(TestCase):
+    def test_verify_batch(self):
+        from ecc.PrivateKey import PrivateKey
+        from ecc.Signature import Signature
+
+        items = []
+        for secret in (1, 2, 0xC0FFEE, N - 1, 2 ** 200 + 7):
+            private_key = PrivateKey(secret)
+            z = secret * 0x1234567 % N
+            items.append((private_key.point, z, private_key.sign(z)))
+        self.assertEqual(verify_batch(items), [True] * len(items))
+        point, z, sig = items[2]
+        items[2] = (point, z + 1, sig)
+        items[3] = (items[3][0], items[3][1], Signature(items[3][2].r, 0))
+        items[4] = (items[4][0], items[4][1], Signature(N, items[4][2].s))
+        self.assertEqual(verify_batch(items), [True, True, False, False, False])
+        for (point, z, sig), result in zip(items, verify_batch(items)):
+            self.assertEqual(point.verify(z, sig), result)
+        self.assertEqual(verify_batch([]), [])
+
+    def test_verify_schnorr_batch(self):
+        from ecc.PrivateKey import PrivateKey
+        from ecc.SchnorrSignature import SchnorrSignature
+
+        items = []
+        for secret in (3, 3, 0xC0FFEE, N - 1, 2 ** 200 + 7, 0xBEEF):
+            private_key = PrivateKey(secret)
+            msg = secret.to_bytes(32, "big")
+            if items and items[-1][0] == private_key.point:
+                msg = b"another " + msg
+            items.append((private_key.point, msg, private_key.sign_schnorr(msg)))
+        self.assertEqual(verify_schnorr_batch(items), [True] * len(items))
+        point, msg, sig = items[2]
+        items[2] = (point, msg + b"\x01", sig)
+        items[3] = (items[3][0], items[3][1], SchnorrSignature(P, items[3][2].s))
+        items[4] = (items[4][0], items[4][1], SchnorrSignature(5, items[4][2].s))
+        want = [True, True, False, False, False, True]
+        self.assertEqual(verify_schnorr_batch(items), want)
+        for (point, msg, sig), result in zip(items, want):
+            self.assertEqual(point.verify_schnorr(msg, sig), result)
+        self.assertEqual(verify_schnorr_batch(items[3:5]), [False, False])
+        self.assertEqual(verify_schnorr_batch([]), [])
+
+    def test_sign_batch(self):
+        from ecc.PrivateKey import PrivateKey
+
+        jobs = [(PrivateKey(secret), secret * 7919) for secret in range(1, 9)]
+        want = [private_key.sign(z) for private_key, z in jobs]
+        for processes in (None, 2):
+            sigs = sign_batch(jobs, processes=processes, verify=True, chunksize=3)
+            self.assertEqual([(s.r, s.s) for s in sigs], [(s.r, s.s) for s in want])
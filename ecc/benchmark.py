@@ -0,0 +1,229 @@
+import argparse
+import json
+import sys
+from timeit import Timer
+from unittest import TestCase
+
+from ecc import limbs
+from ecc.jacobian import batch_to_affine, jacobian_add_affine
+from ecc.PrivateKey import PrivateKey
+from ecc.S256Field import S256Field, P
+from ecc.S256Point import G, N, S256Point, generator_table
+
+# A benchmark regresses when it is this much slower than its baseline
+REGRESSION_THRESHOLD = 0.25
+
+
+def measure(function, min_time=0.2):
+    # Returns the mean seconds per call, repeating until `min_time` has passed
+    timer = Timer(function)
+    number = 1
+    elapsed = timer.timeit(number)
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return elapsed / number
+
+
+def bench_field(min_time=0.2):
+    a = S256Field(0xC0FFEE ** 19 % P)
+    b = S256Field(0xDEADBEEF ** 7 % P)
+    square = a * a
+    return {
+        "field_mul": measure(lambda: a * b, min_time),
+        "field_inv": measure(a.inverse, min_time),
+        "field_sqrt": measure(square.sqrt, min_time),
+    }
+
+
+def bench_point(min_time=0.2):
+    generator_table()
+    p1 = 0xC0FFEE * G
+    p2 = 0xDEADBEEF * G
+    k = 0xB7E151628AED2A6ABF7158809CF4F3C762E7160F38B4DA56A784D9045190CFEF
+    sec = p1.sec()
+    return {
+        "point_add": measure(lambda: p1 + p2, min_time),
+        "point_double": measure(lambda: p1 + p1, min_time),
+        "point_rmul": measure(lambda: k * p1, min_time),
+        "point_rmul_g": measure(lambda: k * G, min_time),
+        "point_parse": measure(lambda: S256Point.parse_uncached(sec), min_time),
+        "point_parse_cached": measure(lambda: S256Point.parse(sec), min_time),
+        "point_sec": measure(p1.sec, min_time),
+    }
+
+
+def bench_keys(min_time=0.2):
+    generator_table()
+    secret = 0x5EC2E7 ** 11 % N
+    private_key = PrivateKey(secret)
+    z = 0xC0FFEE ** 13 % N
+    sig = private_key.sign(z)
+    return {
+        "private_key": measure(lambda: PrivateKey(secret), min_time),
+        "verify": measure(lambda: private_key.point.verify(z, sig), min_time),
+    }
+
+
+def bench_signing(min_time=0.2):
+    generator_table()
+    private_key = PrivateKey(0x5EC2E7 ** 11 % N)
+    zs = [(0xC0FFEE ** 13 + i) % N for i in range(64)]
+    results = {}
+    results["deterministic_k"] = measure(
+        lambda: private_key.deterministic_k(zs[0]), min_time
+    )
+    results["deterministic_k_many"] = measure(
+        lambda: private_key.deterministic_k_many(zs), min_time
+    ) / len(zs)
+    results["sign"] = measure(lambda: private_key.sign(zs[0]), min_time)
+    results["sign_many"] = measure(lambda: private_key.sign_many(zs), min_time) / len(
+        zs
+    )
+    return results
+
+
+def bench_limbs(min_time=0.2, size=10000):
+    # Per element cost of the NumPy limb backend against bignums, empty
+    # without NumPy
+    if not limbs.available():
+        return {}
+    a = [(0xC0FFEE + i) ** 19 % P for i in range(size)]
+    b = [(0xDEADBEEF + i) ** 7 % P for i in range(size)]
+    a_limbs = limbs.to_limbs(a)
+    b_limbs = limbs.to_limbs(b)
+    gx, gy = G.x.num, G.y.num
+    points = [(gx, gy, 1)]
+    for _ in range(size - 1):
+        points.append(jacobian_add_affine(points[-1], gx, gy))
+    return {
+        "batch_mul_bignum": measure(lambda: [x * y % P for x, y in zip(a, b)], min_time)
+        / size,
+        "batch_mul_limbs": measure(lambda: limbs.mul(a_limbs, b_limbs), min_time)
+        / size,
+        "batch_to_affine_bignum": measure(lambda: batch_to_affine(points), min_time)
+        / size,
+        "batch_to_affine_limbs": measure(
+            lambda: limbs.batch_to_affine(points), min_time
+        )
+        / size,
+    }
+
+
+BENCHMARKS = {
+    "field": bench_field,
+    "point": bench_point,
+    "keys": bench_keys,
+    "signing": bench_signing,
+    "limbs": bench_limbs,
+}
+
+
+def run_benchmarks(groups=None, min_time=0.2):
+    # Returns the seconds per call of every benchmark in `groups`, a list of
+    # BENCHMARKS keys which defaults to all of them
+    results = {}
+    for group in groups or BENCHMARKS:
+        results.update(BENCHMARKS[group](min_time))
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    # Returns `(name, baseline seconds, seconds)` for every benchmark that is
+    # more than `threshold` slower than its baseline. Benchmarks missing from
+    # either side are skipped.
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        if seconds > baseline[name] * (1 + threshold):
+            regressions.append((name, baseline[name], seconds))
+    return regressions
+
+
+def dump_results(results, filename):
+    with open(filename, "w") as f:
+        f.write(json.dumps(results, indent=2, sort_keys=True))
+
+
+def load_results(filename):
+    return json.loads(open(filename, "r").read())
+
+
+def main(argv=None):
+    # python -m ecc.benchmark [--baseline FILE [--save-baseline]] [--output FILE]
+    # Exits with status 1 if a benchmark regressed against the baseline
+    parser = argparse.ArgumentParser(description="ecc micro benchmarks")
+    parser.add_argument("groups", nargs="*", help=", ".join(BENCHMARKS))
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the baseline instead of comparing",
+    )
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+    for group in args.groups:
+        if group not in BENCHMARKS:
+            parser.error("unknown benchmark group {}".format(group))
+    results = run_benchmarks(args.groups, args.min_time)
+    baseline = {}
+    if args.baseline and not args.save_baseline:
+        baseline = load_results(args.baseline)
+    for name, seconds in results.items():
+        line = "{:<20} {:>10.1f} us {:>10.0f} / s".format(
+            name, seconds * 1e6, 1 / seconds
+        )
+        if name in baseline:
+            line += " {:>+7.1%}".format(seconds / baseline[name] - 1)
+        print(line)
+    if args.output:
+        dump_results(results, args.output)
+    if args.baseline and args.save_baseline:
+        dump_results(results, args.baseline)
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print(
+            "regression: {} {:.1f} us -> {:.1f} us".format(
+                name, before * 1e6, after * 1e6
+            )
+        )
+    if regressions:
+        return 1
+    return 0
+
+
+class BenchmarkTest(TestCase):
+    def test_measure(self):
+        self.assertGreater(measure(lambda: None, min_time=0.001), 0)
+
+    def test_compare(self):
+        baseline = {"sign": 1.0, "verify": 2.0, "gone": 1.0}
+        results = {"sign": 1.2, "verify": 2.6, "new": 5.0}
+        self.assertEqual(compare(results, baseline), [("verify", 2.0, 2.6)])
+        self.assertEqual(compare(results, baseline, threshold=0.1)[0][0], "sign")
+
+    def test_main(self):
+        import os
+        from contextlib import redirect_stdout
+        from io import StringIO
+        from tempfile import TemporaryDirectory
+
+        with TemporaryDirectory() as directory, redirect_stdout(StringIO()):
+            baseline = os.path.join(directory, "baseline.json")
+            output = os.path.join(directory, "results.json")
+            args = ["field", "--min-time", "0.001", "--baseline", baseline]
+            self.assertEqual(main(args + ["--save-baseline"]), 0)
+            self.assertEqual(
+                set(load_results(baseline)), {"field_mul", "field_inv", "field_sqrt"}
+            )
+            dump_results({name: 1e-12 for name in load_results(baseline)}, baseline)
+            self.assertEqual(main(args + ["--output", output]), 1)
+            self.assertEqual(set(load_results(output)), set(load_results(baseline)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+from unittest import TestCase
+
+from ecc.S256Field import P
+
+# secp256k1 points in Jacobian coordinates are (X, Y, Z) tuples of plain ints
+# standing for the affine point (X / Z^2, Y / Z^3). Any point with Z == 0 is
+# the point at infinity. None of the functions below invert anything, the
+# single inversion happens in `to_affine`.
+INFINITY = (1, 1, 0)
+# `batch_to_affine` hands batches of at least this many points to the NumPy
+# backend in `ecc.limbs` when NumPy is installed. None keeps everything on
+# bignums, which on CPython are still 2-3x faster even for 100k points.
+LIMB_BATCH_SIZE = None
+
+
+def batch_inverse(values, modulus):
+    # Montgomery's trick: inverts every (non-zero) value with one modular
+    # inversion and three multiplications per value
+    prefixes = []
+    acc = 1
+    for value in values:
+        prefixes.append(acc)
+        acc = acc * value % modulus
+    inv = pow(acc, -1, modulus)
+    result = [0] * len(values)
+    for i in reversed(range(len(values))):
+        result[i] = prefixes[i] * inv % modulus
+        inv = inv * values[i] % modulus
+    return result
+
+
+def to_jacobian(x, y):
+    return (x, y, 1)
+
+
+def to_affine(point):
+    x, y, z = point
+    if z == 0:
+        return None
+    z_inv = pow(z, -1, P)
+    z_inv2 = z_inv * z_inv % P
+    return (x * z_inv2 % P, y * z_inv2 * z_inv % P)
+
+
+def batch_to_affine(points):
+    # Normalizes many points with a single inversion, infinity maps to None
+    if LIMB_BATCH_SIZE is not None and len(points) >= LIMB_BATCH_SIZE:
+        # Imported here so that NumPy is only loaded once the backend is used
+        from ecc import limbs
+
+        if limbs.available():
+            return limbs.batch_to_affine(points)
+    finite = [i for i, point in enumerate(points) if point[2] != 0]
+    z_invs = batch_inverse([points[i][2] for i in finite], P)
+    result = [None] * len(points)
+    for i, z_inv in zip(finite, z_invs):
+        x, y, _ = points[i]
+        z_inv2 = z_inv * z_inv % P
+        result[i] = (x * z_inv2 % P, y * z_inv2 * z_inv % P)
+    return result
+
+
+def jacobian_neg(point):
+    x, y, z = point
+    return (x, P - y if y else 0, z)
+
+
+def jacobian_double(point):
+    x1, y1, z1 = point
+    if z1 == 0 or y1 == 0:
+        return INFINITY
+    # dbl-2009-l, valid for curves with a == 0
+    a = x1 * x1 % P
+    b = y1 * y1 % P
+    c = b * b % P
+    d = 2 * ((x1 + b) * (x1 + b) - a - c) % P
+    e = 3 * a % P
+    x3 = (e * e - 2 * d) % P
+    y3 = (e * (d - x3) - 8 * c) % P
+    z3 = 2 * y1 * z1 % P
+    return (x3, y3, z3)
+
+
+def jacobian_add(p1, p2):
+    x1, y1, z1 = p1
+    x2, y2, z2 = p2
+    if z1 == 0:
+        return p2
+    if z2 == 0:
+        return p1
+    # add-2007-bl without the final rescaling
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    if u1 == u2:
+        if s1 != s2:
+            return INFINITY
+        return jacobian_double(p1)
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    z3 = z1 * z2 * h % P
+    return (x3, y3, z3)
+
+
+def jacobian_add_affine(p1, x2, y2):
+    # Mixed addition of a Jacobian point and an affine point (Z2 == 1)
+    x1, y1, z1 = p1
+    if z1 == 0:
+        return (x2, y2, 1)
+    z1z1 = z1 * z1 % P
+    u2 = x2 * z1z1 % P
+    s2 = y2 * z1 * z1z1 % P
+    if x1 == u2:
+        if y1 != s2:
+            return INFINITY
+        return jacobian_double(p1)
+    h = (u2 - x1) % P
+    r = (s2 - y1) % P
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - y1 * hhh) % P
+    z3 = z1 * h % P
+    return (x3, y3, z3)
+
+
+def jacobian_mul(point, coefficient):
+    # Left-to-right double-and-add of an affine `(x, y)` point
+    x, y = point
+    result = INFINITY
+    for bit in bin(coefficient)[2:]:
+        result = jacobian_double(result)
+        if bit == "1":
+            result = jacobian_add_affine(result, x, y)
+    return result
+
+
+def build_comb_table(point, window):
+    # table[i][d] is the affine point d * 2^(window * i) * point, so that a
+    # multiplication only needs one mixed addition per window and no doublings
+    x, y = point
+    size = 1 << window
+    table = []
+    base = (x, y)
+    for _ in range((256 + window - 1) // window):
+        base_x, base_y = base
+        current = to_jacobian(base_x, base_y)
+        row = [current]
+        # the last entry is 2^window * base, the base of the next row
+        for _ in range(size - 1):
+            current = jacobian_add_affine(current, base_x, base_y)
+            row.append(current)
+        row = batch_to_affine(row)
+        base = row.pop()
+        table.append([None] + row)
+    return table
+
+
+def comb_mul(table, coefficient, window):
+    mask = (1 << window) - 1
+    result = INFINITY
+    for row in table:
+        if not coefficient:
+            break
+        digit = coefficient & mask
+        if digit:
+            x, y = row[digit]
+            result = jacobian_add_affine(result, x, y)
+        coefficient >>= window
+    return result
+
+
+def wnaf(coefficient, window):
+    # Width-w non-adjacent form, least significant digit first. Every non-zero
+    # digit is odd and below 2^(w-1) in absolute value.
+    digits = []
+    full = 1 << window
+    half = full >> 1
+    while coefficient:
+        if coefficient & 1:
+            digit = coefficient & (full - 1)
+            if digit >= half:
+                digit -= full
+            coefficient -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        coefficient >>= 1
+    return digits
+
+
+def odd_multiples(point, window):
+    # [1P, 3P, 5P, ..., (2^(w-1) - 1)P] in Jacobian coordinates
+    current = to_jacobian(*point)
+    double = jacobian_double(current)
+    result = [current]
+    for _ in range((1 << (window - 2)) - 1):
+        current = jacobian_add(current, double)
+        result.append(current)
+    return result
+
+
+def jacobian_multi_mul(terms, window=5):
+    # Strauss-Shamir: the sum of coefficient * point for all `(point, coefficient)`
+    # terms, with the wNAF digits of every coefficient interleaved so that all
+    # terms share a single chain of doublings
+    tables = []
+    digits = []
+    for point, coefficient in terms:
+        if coefficient == 0:
+            continue
+        positive = odd_multiples(point, window)
+        tables.append((positive, [jacobian_neg(p) for p in positive]))
+        digits.append(wnaf(coefficient, window))
+    result = INFINITY
+    for i in reversed(range(max((len(d) for d in digits), default=0))):
+        result = jacobian_double(result)
+        for naf, (positive, negative) in zip(digits, tables):
+            if i < len(naf):
+                digit = naf[i]
+                if digit > 0:
+                    result = jacobian_add(result, positive[digit >> 1])
+                elif digit < 0:
+                    result = jacobian_add(result, negative[-digit >> 1])
+    return result
+
+
+class JacobianTest(TestCase):
+    gx = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+    gy = 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8
+
+    def test_batch_inverse(self):
+        values = [1, 2, 3, P - 1, 0xDEADBEEF]
+        for value, inv in zip(values, batch_inverse(values, P)):
+            self.assertEqual(value * inv % P, 1)
+        self.assertEqual(batch_inverse([], P), [])
+        with self.assertRaises(ValueError):
+            batch_inverse([5, 0], P)
+
+    def test_batch_to_affine(self):
+        g = (self.gx, self.gy)
+        points = [jacobian_mul(g, k) for k in (1, 2, 3, 0, 2 ** 100)]
+        want = [to_affine(point) for point in points]
+        self.assertEqual(batch_to_affine(points), want)
+        self.assertIsNone(batch_to_affine(points)[3])
+        self.assertEqual(batch_to_affine([]), [])
+
+    def test_double(self):
+        g = to_jacobian(self.gx, self.gy)
+        want = to_affine(jacobian_add_affine(g, self.gx, self.gy))
+        self.assertEqual(to_affine(jacobian_double(g)), want)
+        self.assertEqual(to_affine(jacobian_add(g, g)), want)
+
+    def test_add(self):
+        g = to_jacobian(self.gx, self.gy)
+        g2 = jacobian_double(g)
+        g3 = jacobian_add(g2, g)
+        self.assertEqual(to_affine(g3), to_affine(jacobian_mul((self.gx, self.gy), 3)))
+        self.assertEqual(
+            to_affine(jacobian_add(g3, jacobian_neg(g2))), (self.gx, self.gy)
+        )
+        self.assertIsNone(to_affine(jacobian_add(g2, jacobian_neg(g2))))
+        self.assertEqual(jacobian_add(INFINITY, g2), g2)
+        self.assertEqual(jacobian_add(g2, INFINITY), g2)
+
+    def test_mul(self):
+        from ecc.FieldElement import FieldElement
+        from ecc.Point import Point
+
+        a = FieldElement(0, P)
+        b = FieldElement(7, P)
+        g = Point(FieldElement(self.gx, P), FieldElement(self.gy, P), a, b)
+        for k in (1, 2, 7, 2 ** 128 + 3):
+            want = k * g
+            got = to_affine(jacobian_mul((self.gx, self.gy), k))
+            self.assertEqual(got, (want.x.num, want.y.num))
+        n = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+        self.assertIsNone(to_affine(jacobian_mul((self.gx, self.gy), n)))
+
+    def test_comb_mul(self):
+        g = (self.gx, self.gy)
+        table = build_comb_table(g, 4)
+        self.assertEqual(len(table), 64)
+        for k in (1, 15, 16, 0xDEADBEEF, 2 ** 255 + 2 ** 17 - 1):
+            want = to_affine(jacobian_mul(g, k))
+            self.assertEqual(to_affine(comb_mul(table, k, 4)), want)
+        self.assertIsNone(to_affine(comb_mul(table, 0, 4)))
+
+    def test_wnaf(self):
+        for k in (1, 7, 31, 1000, 2 ** 255 - 19):
+            digits = wnaf(k, 5)
+            self.assertEqual(sum(d << i for i, d in enumerate(digits)), k)
+            for d in digits:
+                self.assertTrue(d == 0 or (d % 2 == 1 and abs(d) < 16))
+
+    def test_multi_mul(self):
+        g = (self.gx, self.gy)
+        h = to_affine(jacobian_mul(g, 0xC0FFEE))
+        terms = [(g, 2 ** 200 + 5), (h, 0xABCDEF0123456789), (g, 3)]
+        want = INFINITY
+        for point, k in terms:
+            want = jacobian_add(want, jacobian_mul(point, k))
+        self.assertEqual(to_affine(jacobian_multi_mul(terms)), to_affine(want))
+        self.assertIsNone(to_affine(jacobian_multi_mul([(g, 0)])))
+        self.assertIsNone(to_affine(jacobian_multi_mul([])))
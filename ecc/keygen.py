@@ -0,0 +1,103 @@
+from multiprocessing import Pool
+from unittest import TestCase
+
+from ecc.jacobian import jacobian_add_affine
+from ecc.S256Point import (
+    G,
+    N,
+    S256Point,
+    load_generator_table,
+    multi_mul_jacobian,
+)
+from shared.utils import encode_base58_checksum, hash160
+
+
+def generate_keys(
+    start,
+    count,
+    compressed=True,
+    testnet=False,
+    batch_size=1024,
+    processes=None,
+    chunk_size=65536,
+    table_file=None,
+):
+    # Yields `(secret, sec, hash160, address)` for the secrets start, start + 1,
+    # ..., start + count - 1 in order. Only `start` costs a multiplication, every
+    # following key is one point addition away from the previous one and each
+    # batch of keys is normalized with a single inversion.
+    # With `processes` the range is cut into chunks of `chunk_size` secrets that
+    # are generated in a process pool, `table_file` is then handed to
+    # `load_generator_table` in every worker.
+    if start < 1 or start + count > N:
+        raise ValueError("secrets must be between 1 and N - 1")
+    if processes is None:
+        yield from generate_range(start, count, compressed, testnet, batch_size)
+        return
+    chunks = [
+        (chunk, min(chunk_size, start + count - chunk), compressed, testnet, batch_size)
+        for chunk in range(start, start + count, chunk_size)
+    ]
+    with Pool(processes, initializer=init_worker, initargs=(table_file,)) as pool:
+        for keys in pool.imap(generate_chunk, chunks):
+            yield from keys
+
+
+def generate_range(start, count, compressed=True, testnet=False, batch_size=1024):
+    if testnet:
+        prefix = b"\x6f"
+    else:
+        prefix = b"\x00"
+    gx, gy = G.x.num, G.y.num
+    current = multi_mul_jacobian([(start, G)])
+    secret = start
+    remaining = count
+    while remaining > 0:
+        size = min(batch_size, remaining)
+        batch = []
+        for _ in range(size):
+            batch.append(current)
+            current = jacobian_add_affine(current, gx, gy)
+        for offset, sec in enumerate(S256Point.sec_many(batch, compressed)):
+            h160 = hash160(sec)
+            address = encode_base58_checksum(prefix + h160)
+            yield secret + offset, sec, h160, address
+        secret += size
+        remaining -= size
+
+
+def init_worker(table_file):
+    if table_file is not None:
+        load_generator_table(table_file)
+
+
+def generate_chunk(args):
+    return list(generate_range(*args))
+
+
+class KeygenTest(TestCase):
+    def test_generate_keys(self):
+        from ecc.PrivateKey import PrivateKey
+
+        keys = list(generate_keys(5000, 7, batch_size=3))
+        self.assertEqual([key[0] for key in keys], list(range(5000, 5007)))
+        for secret, sec, h160, address in keys:
+            point = PrivateKey(secret).point
+            self.assertEqual(sec, point.sec())
+            self.assertEqual(h160, point.hash160())
+            self.assertEqual(address, point.address())
+        secret, _, _, address = next(
+            generate_keys(5002, 1, compressed=False, testnet=True)
+        )
+        self.assertEqual(address, "mmTPbXQFxboEtNRkwfh6K51jvdtHLxGeMA")
+
+    def test_generate_keys_parallel(self):
+        want = list(generate_keys(N - 10, 9, batch_size=4))
+        got = list(generate_keys(N - 10, 9, processes=2, chunk_size=4))
+        self.assertEqual(got, want)
+
+    def test_range(self):
+        with self.assertRaises(ValueError):
+            next(generate_keys(0, 1))
+        with self.assertRaises(ValueError):
+            next(generate_keys(N - 1, 2))
@@ -0,0 +1,187 @@
+from unittest import TestCase, skipIf
+
+from ecc.S256Field import P
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Batches of field elements are (8, n) uint64 arrays, row i holding bits
+# 32 * i to 32 * i + 31 of every element. Products of two limbs fit in 64
+# bits and are split into 32 bit halves right away, so column sums never
+# overflow. All functions return fully reduced batches.
+LIMBS = 8
+LIMB_BITS = 32
+# P == 2^256 - 2^32 - 977, so 2^256 == 2^32 + 977 (mod P)
+FOLD = 977
+
+if numpy is not None:
+    LIMB_MASK = numpy.uint64((1 << LIMB_BITS) - 1)
+    LIMB_SHIFT = numpy.uint64(LIMB_BITS)
+    P_LIMBS = [numpy.uint64(P >> (LIMB_BITS * i) & 0xFFFFFFFF) for i in range(LIMBS)]
+
+
+def available():
+    return numpy is not None
+
+
+def to_limbs(values):
+    data = b"".join(value.to_bytes(32, "little") for value in values)
+    words = numpy.frombuffer(data, dtype="<u4").reshape(len(values), LIMBS)
+    return words.T.astype(numpy.uint64)
+
+
+def from_limbs(limbs):
+    data = limbs.T.astype("<u4").tobytes()
+    return [int.from_bytes(data[i : i + 32], "little") for i in range(0, len(data), 32)]
+
+
+def propagate(columns):
+    # Carries column sums into 32 bit limbs, returns (limbs, final carry)
+    limbs = numpy.empty((len(columns), columns.shape[1]), numpy.uint64)
+    carry = numpy.zeros(columns.shape[1], numpy.uint64)
+    for i, column in enumerate(columns):
+        column = column + carry
+        limbs[i] = column & LIMB_MASK
+        carry = column >> LIMB_SHIFT
+    return limbs, carry
+
+
+def fold(limbs, top):
+    # limbs + top * 2^256 == limbs + top * (2^32 + 977) (mod P)
+    columns = limbs.copy()
+    columns[0] += top * numpy.uint64(FOLD)
+    columns[1] += top
+    return propagate(columns)
+
+
+def reduce(limbs, top):
+    # Fully reduces limbs + top * 2^256 for a top below 2^34. The first fold
+    # leaves a top of at most 1, the second one only carries out if the
+    # limbs wrap around to a small value, which the third absorbs.
+    limbs, top = fold(limbs, top)
+    limbs, top = fold(limbs, top)
+    limbs, top = fold(limbs, top)
+    # Now below 2^256, subtract P where adding 2^32 + 977 carries out
+    shifted, carry = fold(limbs, numpy.ones(limbs.shape[1], numpy.uint64))
+    return numpy.where(carry.astype(bool), shifted, limbs)
+
+
+def mul(a, b):
+    n = a.shape[1]
+    products = a[:, None, :] * b[None, :, :]
+    low = products & LIMB_MASK
+    high = products >> LIMB_SHIFT
+    columns = numpy.zeros((2 * LIMBS, n), numpy.uint64)
+    for i in range(LIMBS):
+        columns[i : i + LIMBS] += low[i]
+        columns[i + 1 : i + LIMBS + 1] += high[i]
+    limbs, _ = propagate(columns)
+    # limbs[8:] * 2^256 == limbs[8:] * 977 + limbs[8:] * 2^32 (mod P)
+    high = limbs[LIMBS:]
+    columns = numpy.zeros((LIMBS + 1, n), numpy.uint64)
+    columns[:LIMBS] = limbs[:LIMBS]
+    columns[:LIMBS] += high * numpy.uint64(FOLD)
+    columns[1:] += high
+    limbs, top = propagate(columns)
+    return reduce(limbs[:LIMBS], limbs[LIMBS] + (top << LIMB_SHIFT))
+
+
+def add(a, b):
+    limbs, top = propagate(a + b)
+    return reduce(limbs, top)
+
+
+def neg(a):
+    # P - a for every element, zero stays zero
+    limbs = numpy.empty_like(a)
+    borrow = numpy.zeros(a.shape[1], numpy.uint64)
+    for i in range(LIMBS):
+        column = P_LIMBS[i] + (LIMB_MASK + numpy.uint64(1)) - a[i] - borrow
+        limbs[i] = column & LIMB_MASK
+        borrow = numpy.uint64(1) - (column >> LIMB_SHIFT)
+    zero = ~a.any(axis=0)
+    limbs[:, zero] = 0
+    return limbs
+
+
+def sub(a, b):
+    return add(a, neg(b))
+
+
+def batch_inverse(a):
+    # Inverts every (non-zero) element of a batch with a product tree, which
+    # keeps every multiplication vectorized, and one bignum inversion
+    levels = [a]
+    while levels[-1].shape[1] > 1:
+        level = levels[-1]
+        if level.shape[1] % 2:
+            one = numpy.zeros((LIMBS, 1), numpy.uint64)
+            one[0] = 1
+            level = numpy.concatenate([level, one], axis=1)
+            levels[-1] = level
+        levels.append(mul(level[:, 0::2], level[:, 1::2]))
+    inverse = to_limbs([pow(from_limbs(levels[-1])[0], -1, P)])
+    for level in reversed(levels[:-1]):
+        # Drop the inverse of the padding one of the level above
+        inverse = inverse[:, : level.shape[1] // 2]
+        result = numpy.empty_like(level)
+        result[:, 0::2] = mul(inverse, level[:, 1::2])
+        result[:, 1::2] = mul(inverse, level[:, 0::2])
+        inverse = result
+    return inverse[:, : a.shape[1]]
+
+
+def batch_to_affine(points):
+    # Same as `jacobian.batch_to_affine`, with all field arithmetic on limbs
+    finite = [i for i, point in enumerate(points) if point[2] != 0]
+    result = [None] * len(points)
+    if not finite:
+        return result
+    x = to_limbs([points[i][0] % P for i in finite])
+    y = to_limbs([points[i][1] % P for i in finite])
+    z_inv = batch_inverse(to_limbs([points[i][2] % P for i in finite]))
+    z_inv2 = mul(z_inv, z_inv)
+    xs = from_limbs(mul(x, z_inv2))
+    ys = from_limbs(mul(y, mul(z_inv2, z_inv)))
+    for i, affine in zip(finite, zip(xs, ys)):
+        result[i] = affine
+    return result
+
+
+@skipIf(numpy is None, "NumPy is not installed")
+class LimbsTest(TestCase):
+    values = [0, 1, 2, 977, 2 ** 32, 2 ** 255 + 12345, P - 1, P - 2 ** 32, 3 ** 160]
+
+    def test_roundtrip(self):
+        self.assertEqual(from_limbs(to_limbs(self.values)), self.values)
+
+    def test_arithmetic(self):
+        a = self.values
+        b = list(reversed(self.values))
+        la, lb = to_limbs(a), to_limbs(b)
+        self.assertEqual(from_limbs(mul(la, lb)), [x * y % P for x, y in zip(a, b)])
+        self.assertEqual(from_limbs(add(la, lb)), [(x + y) % P for x, y in zip(a, b)])
+        self.assertEqual(from_limbs(sub(la, lb)), [(x - y) % P for x, y in zip(a, b)])
+
+    def test_batch_to_affine(self):
+        from ecc import jacobian
+        from ecc.jacobian import batch_to_affine as bignum_batch_to_affine
+        from ecc.jacobian import INFINITY, jacobian_mul
+
+        g = (
+            0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+            0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
+        )
+        points = [jacobian_mul(g, k) for k in (2, 3, 5000, 2 ** 200)]
+        points.insert(2, INFINITY)
+        want = bignum_batch_to_affine(points)
+        self.assertEqual(batch_to_affine(points), want)
+        self.assertEqual(batch_to_affine(points[:1]), want[:1])
+        self.assertEqual(batch_to_affine([INFINITY]), [None])
+        jacobian.LIMB_BATCH_SIZE = 2
+        try:
+            self.assertEqual(bignum_batch_to_affine(points), want)
+        finally:
+            jacobian.LIMB_BATCH_SIZE = None
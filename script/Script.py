@@ -3,13 +3,20 @@ from hashlib import sha256
 from logging import getLogger
 from unittest import TestCase
 
-from script.op import OP_CODE_FUNCTIONS, OP_CODE_NAMES, op_equal, op_hash160, op_verify
+from script.op import (
+    CALL_BRANCHES,
+    OP_CODE_DISPATCH,
+    OP_CODE_NAMES,
+    op_equal,
+    op_hash160,
+    op_verify,
+)
+from shared.LRUCache import LRUCache
 from shared.utils import (
     encode_varint,
     h160_to_p2pkh_address,
     h160_to_p2sh_address,
     int_to_little_endian,
-    little_endian_to_int,
     read_varint,
 )
 
@@ -31,14 +38,210 @@ def p2wsh_script(h256):
 
 
 LOGGER = getLogger(__name__)
+# Standard scriptPubKey templates, see `classify_script_pubkey`
+P2PKH = "p2pkh"
+P2SH = "p2sh"
+P2WPKH = "p2wpkh"
+P2WSH = "p2wsh"
+# Compiled scripts kept by `Script.parse_compiled`
+COMPILED_CACHE_SIZE = 1024
 
 
-class Script:
-    def __init__(self, cmds=None):
-        if cmds is None:
-            self.cmds = []
+def classify_script_pubkey(raw):
+    # Returns `(template, hash)` for the raw bytes of a standard scriptPubKey
+    # with nothing but length and fixed byte checks, (None, None) otherwise
+    length = len(raw)
+    if length == 25:
+        if raw[:3] == b"\x76\xa9\x14" and raw[23:] == b"\x88\xac":
+            return P2PKH, raw[3:23]
+    elif length == 23:
+        if raw[:2] == b"\xa9\x14" and raw[22] == 0x87:
+            return P2SH, raw[2:22]
+    elif length == 22:
+        if raw[:2] == b"\x00\x14":
+            return P2WPKH, raw[2:]
+    elif length == 34:
+        if raw[:2] == b"\x00\x20":
+            return P2WSH, raw[2:]
+    return None, None
+
+
+def parse_cmds(raw, limit=None, zero_copy=False):
+    # Returns the commands of raw script bytes without the length prefix,
+    # scanning them by offset. Parsing stops after `limit` commands if given,
+    # with zero_copy=True pushes are memoryview slices of `raw` instead of
+    # bytes copies. Truncated pushes raise a SyntaxError.
+    data = memoryview(raw) if zero_copy else bytes(raw)
+    length = len(data)
+    if limit is None:
+        limit = length
+    cmds = []
+    i = 0
+    while i < length and len(cmds) < limit:
+        current_byte = data[i]
+        i += 1
+        if current_byte == 0 or current_byte > 78:
+            cmds.append(current_byte)
+            continue
+        if current_byte <= 75:
+            n = current_byte
+        # OP_PUSHDATA1
+        elif current_byte == 76:
+            if i + 1 > length:
+                raise SyntaxError("parsing script failed")
+            n = data[i]
+            i += 1
+        # OP_PUSHDATA2
+        elif current_byte == 77:
+            if i + 2 > length:
+                raise SyntaxError("parsing script failed")
+            n = data[i] | data[i + 1] << 8
+            i += 2
+        # OP_PUSHDATA4
         else:
-            self.cmds = cmds
+            if i + 4 > length:
+                raise SyntaxError("parsing script failed")
+            n = int.from_bytes(data[i : i + 4], "little")
+            i += 4
+        if i + n > length:
+            raise SyntaxError("parsing script failed")
+        cmds.append(data[i : i + n])
+        i += n
+    return cmds
+
+
+def compile_cmds(cmds):
+    # Returns the commands as a tuple of `(op_code, operation, call, data)`
+    # entries. Pushes have an op_code of None and their bytes as data, opcodes
+    # carry their function and calling convention from OP_CODE_DISPATCH.
+    # OP_IF, OP_NOTIF and OP_ELSE get the relative jump to the next OP_ELSE or
+    # OP_ENDIF of their own conditional as data, or to the end of the program
+    # if there is none. Unknown opcodes compile to entries that fail once
+    # they are reached.
+    program = []
+    branches = []
+    for cmd in cmds:
+        if type(cmd) != int:
+            program.append([None, None, None, cmd])
+        elif OP_CODE_DISPATCH[cmd] is None:
+            program.append([cmd, None, None, None])
+        else:
+            operation, call = OP_CODE_DISPATCH[cmd]
+            if call == CALL_BRANCHES:
+                if cmd in (103, 104) and branches:
+                    start = branches.pop()
+                    program[start][3] = len(program) - start - 1
+                if cmd != 104:
+                    branches.append(len(program))
+            program.append([cmd, operation, call, None])
+    for start in branches:
+        program[start][3] = len(program) - start - 1
+    return tuple(tuple(entry) for entry in program)
+
+
+def execute(program, z, witness=None):
+    # Runs a program from `compile_cmds`. A p2sh redeem script, a witness
+    # program or a witness script replace the rest of the program when they
+    # are reached, redeem and witness scripts come from the compiled cache.
+    pc = 0
+    stack = []
+    altstack = []
+    branches = []
+    call_args = ((stack,), (stack, altstack), (stack, z), (stack, branches))
+    while pc < len(program):
+        op_code, operation, call, data = program[pc]
+        pc += 1
+        if op_code is not None:
+            if call is None or call > CALL_BRANCHES:
+                ok = False
+            else:
+                ok = operation(*call_args[call])
+            if not ok:
+                LOGGER.info("bad op: {}".format(OP_CODE_NAMES.get(op_code, op_code)))
+                return False
+            if data and not branches[-1]:
+                # Skip the branch that is not taken
+                pc += data
+            continue
+        stack.append(data)
+        if (
+            len(program) - pc == 3
+            and program[pc][0] == 0xA9
+            and program[pc + 1][0] is None
+            and len(program[pc + 1][3]) == 20
+            and program[pc + 2][0] == 0x87
+        ):
+            h160 = program[pc + 1][3]
+            if not op_hash160(stack):
+                return False
+            stack.append(h160)
+            if not op_equal(stack):
+                return False
+            if not op_verify(stack):
+                LOGGER.info("bad p2sh h160")
+                return False
+            program = Script.parse_compiled(data)[1]
+            pc = 0
+        if len(stack) == 2 and stack[0] == b"" and len(stack[1]) == 20:
+            h160 = stack.pop()
+            stack.pop()
+            program = (
+                program[pc:]
+                + compile_cmds(witness)
+                + compile_cmds(p2pkh_script(h160).cmds)
+            )
+            pc = 0
+        if len(stack) == 2 and stack[0] == b"" and len(stack[1]) == 32:
+            s256 = stack.pop()
+            stack.pop()
+            witness_script = witness[-1]
+            if s256 != sha256(witness_script).digest():
+                LOGGER.info(
+                    "bad sha256 {} vs {}".format(
+                        s256.hex(), sha256(witness_script).hexdigest()
+                    )
+                )
+                return False
+            program = (
+                program[pc:]
+                + compile_cmds(witness[:-1])
+                + Script.parse_compiled(witness_script)[1]
+            )
+            pc = 0
+    if branches:
+        LOGGER.info("unbalanced conditional")
+        return False
+    if len(stack) == 0:
+        return False
+    if stack.pop() == b"":
+        return False
+    return True
+
+
+class Script:
+    # `(Script, program)` pairs by raw script bytes, see `parse_compiled`
+    compiled_cache = LRUCache(COMPILED_CACHE_SIZE)
+
+    def __init__(self, cmds=None, raw=None):
+        # A script made from its raw bytes (without the length prefix) only
+        # parses them when `cmds` is first read, and serializes by returning
+        # them. Those commands are a tuple, so that they cannot be changed
+        # behind the raw bytes' back; assigning `cmds` drops the raw bytes.
+        if cmds is None and raw is None:
+            cmds = []
+        self._cmds = cmds
+        self._raw = raw
+
+    @property
+    def cmds(self):
+        if self._cmds is None:
+            self._cmds = tuple(parse_cmds(self._raw))
+        return self._cmds
+
+    @cmds.setter
+    def cmds(self, cmds):
+        self._cmds = cmds
+        self._raw = None
 
     def __repr__(self):
         result = []
@@ -54,25 +257,31 @@ class Script:
         return " ".join(result)
 
     def __add__(self, other):
-        return Script(self.cmds + other.cmds)
+        return Script(list(self.cmds) + list(other.cmds))
 
     def raw_serialize(self):
+        if self._raw is not None:
+            return self._raw
         result = b""
         for cmd in self.cmds:
             if type(cmd) == int:
                 result += int_to_little_endian(cmd, 1)
             else:
                 length = len(cmd)
-                if length < 75:
+                if length <= 75:
                     result += int_to_little_endian(length, 1)
                 # OP_PUSHDATA1
-                elif length > 75 and length < 0x100:
+                elif length < 0x100:
                     result += int_to_little_endian(76, 1)
                     result += int_to_little_endian(length, 1)
                 # OP_PUSHDATA2
-                elif length >= 0x100 and length <= 520:
+                elif length < 0x10000:
                     result += int_to_little_endian(77, 1)
                     result += int_to_little_endian(length, 2)
+                # OP_PUSHDATA4
+                elif length < 0x100000000:
+                    result += int_to_little_endian(78, 1)
+                    result += int_to_little_endian(length, 4)
                 else:
                     raise ValueError("too long an cmd")
                 result += cmd
@@ -83,81 +292,14 @@ class Script:
         total = len(result)
         return encode_varint(total) + result
 
-    def evaluate(self, z, witness):
-        cmds = self.cmds[:]
-        stack = []
-        altstack = []
-        while len(cmds) > 0:
-            cmd = cmds.pop(0)
-            if type(cmd) == int:
-                operation = OP_CODE_FUNCTIONS[cmd]
-                if cmd in (99, 100):
-                    if not operation(stack, cmds):
-                        LOGGER.info("bad op: {}".format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (107, 108):
-                    if not operation(stack, altstack):
-                        LOGGER.info("bad op: {}".format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (172, 173, 174, 175):
-                    if not operation(stack, z):
-                        LOGGER.info("bad op: {}".format(OP_CODE_NAMES[cmd]))
-                        return False
-                else:
-                    if not operation(stack):
-                        LOGGER.info("bad op: {}".format(OP_CODE_NAMES[cmd]))
-                        return False
-            else:
-                stack.append(cmd)
-                if (
-                    len(cmds) == 3
-                    and cmds[0] == 0xA9
-                    and type(cmds[1]) == bytes
-                    and len(cmds[1]) == 20
-                    and cmds[2] == 0x87
-                ):
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    cmds.pop()
-                    h160 = cmds.pop()
-                    cmds.pop()
-                    if not op_hash160(stack):
-                        return False
-                    stack.append(h160)
-                    if not op_equal(stack):
-                        return False
-                    if not op_verify(stack):
-                        LOGGER.info("bad p2sh h160")
-                        return False
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    stream = BytesIO(redeem_script)
-                    cmds.extend(Script.parse(stream).cmds)
-                if len(stack) == 2 and stack[0] == b"" and len(stack[1]) == 20:
-                    h160 = stack.pop()
-                    stack.pop()
-                    cmds.extend(witness)
-                    cmds.extend(p2pkh_script(h160).cmds)
-                if len(stack) == 2 and stack[0] == b"" and len(stack[1]) == 32:
-                    s256 = stack.pop()
-                    stack.pop()
-                    cmds.extend(witness[:-1])
-                    witness_script = witness[-1]
-                    if s256 != sha256(witness_script):
-                        print(
-                            "bad sha256 {} vs {}".format(
-                                s256.hex(), sha256(witness_script).hex()
-                            )
-                        )
-                        return False
-                    stream = BytesIO(
-                        encode_varint(len(witness_script)) + witness_script
-                    )
-                    witness_script_cmds = Script.parse(stream).cmds
-                    cmds.extend(witness_script_cmds)
-        if len(stack) == 0:
-            return False
-        if stack.pop() == b"":
-            return False
-        return True
+    def compile(self):
+        return compile_cmds(self.cmds)
+
+    def evaluate(self, z, witness=None):
+        return execute(self.compile(), z, witness)
+
+    def template(self):
+        return classify_script_pubkey(self.raw_serialize())
 
     def is_p2pkh_script_pubkey(self):
         return (
@@ -204,35 +346,26 @@ class Script:
             return h160_to_p2sh_address(h160, testnet)
         raise ValueError("Unknown ScriptPubKey")
 
+    @classmethod
+    def parse_compiled(cls, raw):
+        # Returns `(script, program)` for raw script bytes without the length
+        # prefix, e.g. a redeem or witness script. Both are shared through
+        # `compiled_cache` and must not be modified.
+        key = bytes(raw)
+        compiled = cls.compiled_cache.get(key)
+        if compiled is None:
+            script = cls(raw=key)
+            compiled = (script, script.compile())
+            cls.compiled_cache.put(key, compiled)
+        return compiled
+
     @classmethod
     def parse(cls, s):
         length = read_varint(s)
-        cmds = []
-        count = 0
-        while count < length:
-            current = s.read(1)
-            count += 1
-            current_byte = current[0]
-            if current_byte >= 1 and current_byte <= 75:
-                n = current_byte
-                cmds.append(s.read(n))
-                count += n
-            # OP_PUSHDATA1
-            elif current_byte == 76:
-                data_length = little_endian_to_int(s.read(1))
-                cmds.append(s.read(data_length))
-                count += data_length + 1
-            # OP_PUSHDATA2
-            elif current_byte == 77:
-                data_length = little_endian_to_int(s.read(2))
-                cmds.append(s.read(data_length))
-                count += data_length + 2
-            else:
-                op_code = current_byte
-                cmds.append(op_code)
-        if count != length:
+        raw = s.read(length)
+        if len(raw) != length:
             raise SyntaxError("parsing script failed")
-        return cls(cmds)
+        return cls(raw=raw)
 
 
 class ScriptTest(TestCase):
@@ -256,6 +389,67 @@ class ScriptTest(TestCase):
         combined_script = script_sig + script_pubkey
         self.assertTrue(combined_script.evaluate(0))
 
+    def test_evaluate_if(self):
+        # OP_1 OP_IF OP_0 OP_NOTIF OP_2 OP_ELSE OP_3 OP_ENDIF OP_ELSE OP_4 OP_ENDIF
+        script = Script([0x51, 0x63, 0x00, 0x64, 0x52, 0x67, 0x53, 0x68, 0x67, 0x54])
+        self.assertFalse(script.evaluate(0))
+        script = script + Script([0x68, 0x6B, 0x6C, 0x52, 0x87])
+        self.assertTrue(script.evaluate(0))
+        self.assertFalse(Script([0x00, 0x63, 0x51, 0x67, 0x00, 0x68]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x67]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x68]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x51, 0x63]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x00, 0x63]).evaluate(0))
+        # OP_ELSE flips the branch each time, OP_0 OP_IF OP_ELSE OP_2 OP_ELSE
+        # OP_3 OP_ENDIF only runs OP_2
+        script = Script([0x00, 0x63, 0x67, 0x52, 0x67, 0x53, 0x68])
+        self.assertTrue((script + Script([0x52, 0x87])).evaluate(0))
+        script = Script([0x51, 0x63, 0x67, 0x52, 0x67, 0x53, 0x68])
+        self.assertTrue((script + Script([0x53, 0x87])).evaluate(0))
+        self.assertFalse(Script([0x51, 0xB1]).evaluate(0))
+
+    def test_evaluate_p2sh(self):
+        from shared.utils import hash160
+
+        redeem_script = bytes([0x52, 0x52, 0x87])
+        script_sig = Script([redeem_script])
+        self.assertTrue((script_sig + p2sh_script(hash160(redeem_script))).evaluate(0))
+        self.assertFalse((script_sig + p2sh_script(bytes(20))).evaluate(0))
+
+    def test_parse_compiled(self):
+        from script.op import op_0, op_1, op_2, op_else, op_endif, op_if
+
+        raw = bytes([0x52, 0x63, 0x51, 0x67, 0x00, 0x68])
+        Script.compiled_cache.clear()
+        script, program = Script.parse_compiled(raw)
+        self.assertEqual(script.raw_serialize(), raw)
+        self.assertEqual(
+            program,
+            ((82, op_2, 0, None), (99, op_if, 3, 1), (81, op_1, 0, None))
+            + ((103, op_else, 3, 1), (0, op_0, 0, None), (104, op_endif, 3, None)),
+        )
+        self.assertIs(Script.parse_compiled(bytearray(raw))[1], program)
+        self.assertEqual(Script.compiled_cache.stats()["hits"], 1)
+        self.assertTrue(execute(program, 0))
+
+    def test_evaluate_long(self):
+        script = Script([b"\x01"] * 20000 + [0x75] * 19999)
+        self.assertTrue(script.evaluate(0))
+
+    def test_classify_script_pubkey(self):
+        h160 = bytes(range(20))
+        for script, template in (
+            (p2pkh_script(h160), P2PKH),
+            (p2sh_script(h160), P2SH),
+            (p2wpkh_script(h160), P2WPKH),
+        ):
+            self.assertEqual(script.template(), (template, h160))
+        self.assertEqual(p2wsh_script(bytes(32)).template(), (P2WSH, bytes(32)))
+        raw = p2pkh_script(h160).raw_serialize()
+        self.assertEqual(classify_script_pubkey(raw[:-1] + b"\x87"), (None, None))
+        self.assertEqual(classify_script_pubkey(raw[1:]), (None, None))
+        self.assertEqual(Script([0x51]).template(), (None, None))
+
     def test_parse(self):
         script_pubkey = BytesIO(
             bytes.fromhex(
@@ -272,6 +466,46 @@ class ScriptTest(TestCase):
         )
         self.assertEqual(script.cmds[1], want)
 
+    def test_parse_cmds(self):
+        raw = bytes.fromhex("0051") + b"\x02ab" + b"\x4c\x01c" + b"\x4d\x01\x00d"
+        raw += b"\x4e\x01\x00\x00\x00e" + b"\x4b" + bytes(75) + b"\x87"
+        cmds = [0, 0x51, b"ab", b"c", b"d", b"e", bytes(75), 0x87]
+        self.assertEqual(parse_cmds(raw), cmds)
+        self.assertEqual(parse_cmds(raw, limit=3), cmds[:3])
+        views = parse_cmds(raw, zero_copy=True)
+        self.assertEqual(type(views[2]), memoryview)
+        self.assertEqual(
+            [bytes(cmd) if type(cmd) != int else cmd for cmd in views], cmds
+        )
+        self.assertEqual(parse_cmds(memoryview(raw)), cmds)
+        for bad in (b"\x02a", b"\x4c", b"\x4d\x01", b"\x4e\x01\x00\x00", b"\x4c\x02a"):
+            with self.assertRaises(SyntaxError):
+                parse_cmds(bad)
+        self.assertEqual(
+            Script([0, 0x51, b"ab", bytes(75), 0x87]).raw_serialize(),
+            b"\x00\x51\x02ab\x4b" + bytes(75) + b"\x87",
+        )
+        for cmd in (bytes(76), bytes(0x100), bytes(0x10000)):
+            self.assertEqual(parse_cmds(Script([cmd]).raw_serialize()), [cmd])
+
+    def test_lazy(self):
+        # OP_PUSHDATA1 for a 2 byte push is kept as it was parsed
+        raw = b"\x4c\x02ab\x87"
+        script = Script.parse(BytesIO(b"\x05" + raw))
+        self.assertIsNone(script._cmds)
+        self.assertEqual(script.template(), (None, None))
+        self.assertEqual(script.serialize(), b"\x05" + raw)
+        self.assertIsNone(script._cmds)
+        self.assertEqual(script.cmds, (b"ab", 0x87))
+        with self.assertRaises(AttributeError):
+            script.cmds.append(0x87)
+        self.assertEqual(script.raw_serialize(), raw)
+        script.cmds = [b"ab", 0x87]
+        self.assertEqual(script.raw_serialize(), b"\x02ab\x87")
+        script = Script.parse(BytesIO(b"\x02\x02a"))
+        with self.assertRaises(SyntaxError):
+            script.cmds
+
     def test_serialize(self):
         want = "6a47304402207899531a52d59a6de200179928ca900254a36b8dff8bb75f5f5d71b1cdc26125022008b422690b8461cb52c3cc30330b23d574351872b7c361e9aae3649071c1a7160121035d5c93d9ac96881f19ba1f686f15f009ded7c62efe85a872e6a19b43c15a2937"
         script_pubkey = BytesIO(bytes.fromhex(want))
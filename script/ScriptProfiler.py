@@ -0,0 +1,235 @@
+from time import perf_counter
+from unittest import TestCase
+
+from script.op import OP_CODE_DISPATCH, OP_CODE_FUNCTIONS, OP_CODE_NAMES
+from script.Script import Script
+from tx.Tx import Tx
+
+# The uninstrumented tables, restored by `ScriptProfiler.stop`
+ORIGINAL_DISPATCH = list(OP_CODE_DISPATCH)
+ORIGINAL_FUNCTIONS = dict(OP_CODE_FUNCTIONS)
+ORIGINAL_EVALUATE_INPUT = Tx.evaluate_input
+ORIGINAL_VERIFY_SINGLE_SIG_INPUTS = Tx.verify_single_sig_inputs
+
+
+def op_code_name(op_code):
+    return OP_CODE_NAMES.get(op_code, "OP_[{}]".format(op_code))
+
+
+def template_name(script_pubkey):
+    return script_pubkey.template()[0] or "nonstandard"
+
+
+class ScriptProfiler:
+    # Counts and times every opcode the interpreter runs, and times inputs
+    # per template of the spent scriptPubKey: in `Tx.evaluate_input`, in the
+    # batch of `Tx.verify_single_sig_inputs`, whose time is shared evenly by
+    # its inputs, and in `Tx.script_cache` hits, counted as "<template>
+    # cached". While running, the opcode tables hold wrapped functions and
+    # those methods are replaced. Stopping puts the originals back, so a
+    # stopped profiler costs nothing. `trace(op_code, stack, ok)` is called
+    # after every opcode if given; pushes appear in the stack of the next
+    # opcode. Only one profiler can run at a time.
+    running = None
+
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.counts = {}
+        self.times = {}
+        self.template_counts = {}
+        self.template_times = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def instrument(self, op_code, operation):
+        counts = self.counts
+        times = self.times
+
+        def profiled(*args):
+            start = perf_counter()
+            ok = operation(*args)
+            elapsed = perf_counter() - start
+            counts[op_code] = counts.get(op_code, 0) + 1
+            times[op_code] = times.get(op_code, 0.0) + elapsed
+            if self.trace is not None:
+                self.trace(op_code, args[0], ok)
+            return ok
+
+        return profiled
+
+    def add_template(self, template, elapsed):
+        self.template_counts[template] = self.template_counts.get(template, 0) + 1
+        self.template_times[template] = self.template_times.get(template, 0.0) + elapsed
+
+    def instrument_evaluate_input(self):
+        def evaluate_input(tx, input_index):
+            tx_in = tx.tx_ins[input_index]
+            template = template_name(tx_in.script_pubkey(testnet=tx.testnet))
+            start = perf_counter()
+            ok = ORIGINAL_EVALUATE_INPUT(tx, input_index)
+            self.add_template(template, perf_counter() - start)
+            return ok
+
+        return evaluate_input
+
+    def instrument_verify_single_sig_inputs(self):
+        def verify_single_sig_inputs(tx, spents):
+            start = perf_counter()
+            remaining = ORIGINAL_VERIFY_SINGLE_SIG_INPUTS(tx, spents)
+            elapsed = perf_counter() - start
+            if remaining is not None:
+                left = set(map(id, remaining))
+                spents = [spent for spent in spents if id(spent) not in left]
+            for spent in spents:
+                self.add_template(template_name(spent[2]), elapsed / len(spents))
+            return remaining
+
+        return verify_single_sig_inputs
+
+    def instrument_script_cache(self, contains):
+        def cached(witness_hash, input_index, script_pubkey, amount):
+            start = perf_counter()
+            hit = contains(witness_hash, input_index, script_pubkey, amount)
+            if hit:
+                template = template_name(script_pubkey) + " cached"
+                self.add_template(template, perf_counter() - start)
+            return hit
+
+        return cached
+
+    def start(self):
+        if ScriptProfiler.running is not None:
+            raise ValueError("a ScriptProfiler is already running")
+        ScriptProfiler.running = self
+        for op_code, entry in enumerate(ORIGINAL_DISPATCH):
+            if entry is not None:
+                operation, call = entry
+                OP_CODE_DISPATCH[op_code] = (
+                    self.instrument(op_code, operation),
+                    call,
+                )
+        for op_code, entry in enumerate(OP_CODE_DISPATCH):
+            if entry is not None:
+                OP_CODE_FUNCTIONS[op_code] = entry[0]
+        Tx.evaluate_input = self.instrument_evaluate_input()
+        Tx.verify_single_sig_inputs = self.instrument_verify_single_sig_inputs()
+        # Shadows `contains` on the cache object itself until `stop`
+        self.script_cache = Tx.script_cache
+        self.script_cache.contains = self.instrument_script_cache(
+            self.script_cache.contains
+        )
+        # Cached programs hold the functions they were compiled with
+        Script.compiled_cache.clear()
+
+    def stop(self):
+        if ScriptProfiler.running is not self:
+            return
+        OP_CODE_DISPATCH[:] = ORIGINAL_DISPATCH
+        OP_CODE_FUNCTIONS.update(ORIGINAL_FUNCTIONS)
+        Tx.evaluate_input = ORIGINAL_EVALUATE_INPUT
+        Tx.verify_single_sig_inputs = ORIGINAL_VERIFY_SINGLE_SIG_INPUTS
+        del self.script_cache.contains
+        Script.compiled_cache.clear()
+        ScriptProfiler.running = None
+
+    def results(self):
+        # Counts and seconds by opcode name and by template, JSON friendly
+        return {
+            "op_codes": {
+                op_code_name(op_code): {
+                    "count": count,
+                    "seconds": self.times[op_code],
+                }
+                for op_code, count in self.counts.items()
+            },
+            "templates": {
+                template: {
+                    "count": count,
+                    "seconds": self.template_times[template],
+                }
+                for template, count in self.template_counts.items()
+            },
+        }
+
+    def report(self):
+        # One line per opcode and per template, most total time first
+        lines = []
+        for title, rows in sorted(self.results().items()):
+            lines.append(
+                "{:<20} {:>10} {:>12} {:>10}".format(title, "count", "total us", "us")
+            )
+            ordered = sorted(rows.items(), key=lambda row: -row[1]["seconds"])
+            for name, row in ordered:
+                lines.append(
+                    "{:<20} {:>10} {:>12.1f} {:>10.2f}".format(
+                        name,
+                        row["count"],
+                        row["seconds"] * 1e6,
+                        row["seconds"] / row["count"] * 1e6,
+                    )
+                )
+        return "\n".join(lines)
+
+
+class ScriptProfilerTest(TestCase):
+    def test_profile(self):
+        from script.op import op_dup
+
+        steps = []
+        script = Script([0x52, 0x76, 0x93, 0x54, 0x87])
+
+        def trace(op_code, stack, ok):
+            steps.append((op_code, list(stack), ok))
+
+        with ScriptProfiler(trace=trace) as profiler:
+            self.assertIsNot(OP_CODE_FUNCTIONS[0x76], op_dup)
+            self.assertTrue(script.evaluate(0))
+            self.assertTrue(script.evaluate(0))
+            with self.assertRaises(ValueError):
+                ScriptProfiler().start()
+        self.assertIs(OP_CODE_DISPATCH[0x76][0], op_dup)
+        self.assertIs(OP_CODE_FUNCTIONS[0x76], op_dup)
+        self.assertIs(Tx.evaluate_input, ORIGINAL_EVALUATE_INPUT)
+        self.assertIsNone(ScriptProfiler.running)
+        self.assertEqual(
+            steps[:2], [(0x52, [b"\x02"], True), (0x76, [b"\x02", b"\x02"], True)]
+        )
+        results = profiler.results()
+        self.assertEqual(results["op_codes"]["OP_DUP"]["count"], 2)
+        self.assertEqual(results["op_codes"]["OP_EQUAL"]["count"], 2)
+        self.assertEqual(len(profiler.report().splitlines()), 7)
+
+    def test_profile_templates(self):
+        from tx.Tx import TxFetcher
+
+        TxFetcher.load_cache("./tx.cache")
+        tx = TxFetcher.fetch(
+            "46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b"
+        )
+        with ScriptProfiler() as profiler:
+            self.assertTrue(tx.evaluate_input(0))
+        self.assertEqual(profiler.results()["templates"]["p2sh"]["count"], 1)
+        self.assertEqual(profiler.results()["op_codes"]["OP_CHECKMULTISIG"]["count"], 1)
+
+    def test_profile_verify(self):
+        from script import op
+        from tx.Tx import TxFetcher
+
+        TxFetcher.load_cache("./tx.cache")
+        tx = TxFetcher.fetch(
+            "452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03"
+        )
+        Tx.script_cache.clear()
+        op.SIGNATURE_CACHE.clear()
+        with ScriptProfiler() as profiler:
+            self.assertTrue(tx.verify())
+            self.assertTrue(tx.verify())
+        self.assertNotIn("contains", vars(Tx.script_cache))
+        templates = profiler.results()["templates"]
+        self.assertEqual(templates["p2pkh"]["count"], len(tx.tx_ins))
+        self.assertEqual(templates["p2pkh cached"]["count"], len(tx.tx_ins))
@@ -1,10 +1,16 @@
 from ecc.Signature import Signature
+from ecc.SignatureCache import SignatureCache
 from ecc.S256Point import S256Point
 import hashlib
 from unittest import TestCase
 
 from shared.utils import hash160, hash256
 
+# Verified signatures shared by op_checksig, op_checkmultisig and
+# `Tx.verify_inputs`
+SIGNATURE_CACHE_SIZE = 65536
+SIGNATURE_CACHE = SignatureCache(SIGNATURE_CACHE_SIZE)
+
 
 def encode_num(num):
     if num == 0:
@@ -138,71 +144,36 @@ def op_nop(stack):
     return True
 
 
-def op_if(stack, items):
+def op_if(stack, branches):
+    # Conditionals keep one flag per open OP_IF / OP_NOTIF in `branches`, the
+    # interpreter skips ahead to the matching OP_ELSE / OP_ENDIF whenever
+    # the innermost flag is False
     if len(stack) < 1:
         return False
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
-        return False
     element = stack.pop()
-    if decode_num(element) == 0:
-        items[:0] = false_items
-    else:
-        items[:0] = true_items
+    branches.append(decode_num(element) != 0)
     return True
 
 
-def op_notif(stack, items):
+def op_notif(stack, branches):
     if len(stack) < 1:
         return False
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
-        return False
     element = stack.pop()
-    if decode_num(element) == 0:
-        items[:0] = true_items
-    else:
-        items[:0] = false_items
+    branches.append(decode_num(element) == 0)
+    return True
+
+
+def op_else(stack, branches):
+    if len(branches) < 1:
+        return False
+    branches[-1] = not branches[-1]
+    return True
+
+
+def op_endif(stack, branches):
+    if len(branches) < 1:
+        return False
+    branches.pop()
     return True
 
 
@@ -654,7 +625,7 @@ def op_checksig(stack, z):
         sig = Signature.parse(der_signature)
     except (ValueError, SyntaxError):
         return False
-    if point.verify(z, sig):
+    if SIGNATURE_CACHE.verify(point, z, sig):
         stack.append(encode_num(1))
     else:
         stack.append(encode_num(0))
@@ -683,14 +654,15 @@ def op_checkmultisig(stack, z):
     stack.pop()
     try:
         points = [S256Point.parse(sec) for sec in sec_pubkeys]
-        sigs = [Signature.parse(der) for der in der_signatures]
+        sigs = Signature.parse_many(der_signatures)
         for sig in sigs:
-            if len(points) == 0:
-                return False
+            # Every signature needs a match among the remaining pubkeys
             while points:
                 point = points.pop(0)
-                if point.verify(z, sig):
+                if SIGNATURE_CACHE.verify(point, z, sig):
                     break
+            else:
+                return False
         stack.append(encode_num(1))
     except (ValueError, SyntaxError):
         return False
@@ -758,6 +730,8 @@ OP_CODE_FUNCTIONS = {
     97: op_nop,
     99: op_if,
     100: op_notif,
+    103: op_else,
+    104: op_endif,
     105: op_verify,
     106: op_return,
     107: op_toaltstack,
@@ -824,6 +798,39 @@ OP_CODE_FUNCTIONS = {
     185: op_nop,
 }
 
+# Extra arguments an opcode function takes after the main stack. Opcodes
+# that need the transaction's locktime, sequence or version cannot run in
+# `Script.evaluate`, which does not have them.
+CALL_STACK = 0
+CALL_ALTSTACK = 1
+CALL_Z = 2
+CALL_BRANCHES = 3
+CALL_TX = 4
+
+OP_CODE_CALLS = {
+    99: CALL_BRANCHES,
+    100: CALL_BRANCHES,
+    103: CALL_BRANCHES,
+    104: CALL_BRANCHES,
+    107: CALL_ALTSTACK,
+    108: CALL_ALTSTACK,
+    172: CALL_Z,
+    173: CALL_Z,
+    174: CALL_Z,
+    175: CALL_Z,
+    177: CALL_TX,
+    178: CALL_TX,
+}
+
+# `(function, call)` for every opcode, indexed by the opcode, None for
+# opcodes without a function
+OP_CODE_DISPATCH = [
+    (OP_CODE_FUNCTIONS[op_code], OP_CODE_CALLS.get(op_code, CALL_STACK))
+    if op_code in OP_CODE_FUNCTIONS
+    else None
+    for op_code in range(256)
+]
+
 OP_CODE_NAMES = {
     0: "OP_0",
     76: "OP_PUSHDATA1",
@@ -970,3 +977,25 @@ class OpTest(TestCase):
         stack = [b"", sig1, sig2, b"\x02", sec1, sec2, b"\x02"]
         self.assertTrue(op_checkmultisig(stack, z))
         self.assertEqual(decode_num(stack[0]), 1)
+        stack = [b"", sig1, sig2, b"\x02", sec1, sec2, b"\x02"]
+        self.assertFalse(op_checkmultisig(stack, z + 1))
+        stack = [b"", sig2, sig1, b"\x02", sec1, sec2, b"\x02"]
+        self.assertFalse(op_checkmultisig(stack, z))
+
+    def test_signature_cache(self):
+        z = 0x7C076FF316692A3D7EB3C3BB0F8B1488CF72E1AFCD929E29307032997A838A3D
+        sec = bytes.fromhex(
+            "04887387e452b8eacc4acfde10d9aaf7f6d9a0f975aabb10d006e4da568744d06c61de6d95231cd89026e286df3b6ae4a894a3378e393e93a0f45b666329a0ae34"
+        )
+        sig = bytes.fromhex(
+            "3045022000eff69ef2b1bd93a66ed5219add4fb51e11a840f404876325a1e8ffe0529a2c022100c7207fee197d27c618aea621406f6bf5ef6fca38681d82b2f06fddbdce6feab601"
+        )
+        SIGNATURE_CACHE.clear()
+        for _ in range(2):
+            stack = [sig, sec]
+            self.assertTrue(op_checksig(stack, z))
+            self.assertEqual(decode_num(stack[0]), 1)
+        self.assertEqual(SIGNATURE_CACHE.stats()["hits"], 1)
+        stack = [sig, sec]
+        self.assertTrue(op_checksig(stack, z + 1))
+        self.assertEqual(decode_num(stack[0]), 0)
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from threading import Lock
+from unittest import TestCase
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        # A maxsize of 0 turns the cache off, every lookup is then a miss
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "LRUCache(size={}, maxsize={}, hits={}, misses={})".format(
+            len(self._items), self.maxsize, self.hits, self.misses
+        )
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._items) > max(maxsize, 0):
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+        }
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put(b"a", 1)
+        cache.put(b"b", 2)
+        self.assertEqual(cache.get(b"a"), 1)
+        cache.put(b"c", 3)
+        self.assertNotIn(b"b", cache)
+        self.assertIn(b"a", cache)
+        self.assertIn(b"c", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_stats(self):
+        cache = LRUCache(4)
+        cache.put(b"a", 1)
+        cache.get(b"a")
+        cache.get(b"b")
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 1, "size": 1, "maxsize": 4}
+        )
+        cache.clear()
+        self.assertEqual(
+            cache.stats(), {"hits": 0, "misses": 0, "size": 0, "maxsize": 4}
+        )
+
+    def test_resize(self):
+        cache = LRUCache(3)
+        for i in range(3):
+            cache.put(i, i)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertIn(2, cache)
+        cache.discard(2)
+        cache.discard(2)
+        self.assertEqual(len(cache), 0)
+        cache.resize(0)
+        cache.put(5, 5)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get(5))
@@ -0,0 +1,46 @@
+from hashlib import sha256
+from os import urandom
+from unittest import TestCase
+
+from shared.LRUCache import LRUCache
+
+
+class SaltedLRUCache:
+    # A bounded set of entries stored under a salted sha256 of their bytes,
+    # which keeps every entry at a fixed size (about 150 bytes with the LRU
+    # bookkeeping) and stops anyone from predicting keys. The salt is drawn
+    # per process. Subclasses override `key` with their own byte layout,
+    # `contains` and `add` take the same arguments as `key`.
+    def __init__(self, maxsize=65536):
+        self.salt = urandom(32)
+        self.entries = LRUCache(maxsize)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.entries)
+
+    def key(self, data):
+        return sha256(self.salt + data).digest()
+
+    def contains(self, *args):
+        return self.entries.get(self.key(*args)) is not None
+
+    def add(self, *args):
+        self.entries.put(self.key(*args), True)
+
+    def stats(self):
+        return self.entries.stats()
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SaltedLRUCacheTest(TestCase):
+    def test_contains(self):
+        cache = SaltedLRUCache(maxsize=1)
+        cache.add(b"a")
+        self.assertTrue(cache.contains(b"a"))
+        self.assertFalse(cache.contains(b"b"))
+        cache.add(b"b")
+        self.assertFalse(cache.contains(b"a"))
+        self.assertEqual(cache.stats()["size"], 1)
+        self.assertNotEqual(SaltedLRUCache().key(b"a"), cache.key(b"a"))
@@ -5,6 +5,8 @@ from unittest import TestCase
 SIGHASH_ALL = 1
 TWO_WEEKS = 60 * 60 * 24 * 14
 BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+# sha256 states that have already absorbed sha256(tag) || sha256(tag)
+_tag_states = {}
 
 
 def encode_base58(s):
@@ -61,6 +63,19 @@ def hash160(s):
     return hashlib.new("ripemd160", hashlib.sha256(s).digest()).digest()
 
 
+def tagged_hash(tag, msg):
+    # BIP340 tagged hash, sha256(sha256(tag) || sha256(tag) || msg). The 64
+    # byte prefix is exactly one sha256 block, so its state is kept per tag.
+    state = _tag_states.get(tag)
+    if state is None:
+        tag_hash = hashlib.sha256(tag.encode("ascii")).digest()
+        state = hashlib.sha256(tag_hash + tag_hash)
+        _tag_states[tag] = state
+    state = state.copy()
+    state.update(msg)
+    return state.digest()
+
+
 def encode_base58_checksum(b):
     return encode_base58(b + hash256(b)[:4])
 
@@ -218,6 +233,12 @@ class UtilsTest(TestCase):
         got = encode_base58_checksum(b"\x6f" + bytes.fromhex(h160))
         self.assertEqual(got, addr)
 
+    def test_tagged_hash(self):
+        tag_hash = hashlib.sha256(b"BIP0340/challenge").digest()
+        want = hashlib.sha256(tag_hash + tag_hash + b"msg").digest()
+        self.assertEqual(tagged_hash("BIP0340/challenge", b"msg"), want)
+        self.assertEqual(tagged_hash("BIP0340/challenge", b"msg"), want)
+
     def test_little_endian_to_int(self):
         h = bytes.fromhex("99c3980000000000")
         want = 10011545
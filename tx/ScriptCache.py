@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from shared.SaltedLRUCache import SaltedLRUCache
+from shared.utils import int_to_little_endian
+
+
+class ScriptCache(SaltedLRUCache):
+    # Remembers inputs whose scripts passed, keyed by the transaction's
+    # `witness_hash()`, the input index and the spent output. The witness hash
+    # commits to the scriptSig and the witness, so an entry is only ever found
+    # for the exact same spend.
+    def key(self, witness_hash, input_index, script_pubkey, amount):
+        data = (
+            witness_hash
+            + int_to_little_endian(input_index, 4)
+            + int_to_little_endian(amount, 8)
+            + script_pubkey.serialize()
+        )
+        return super().key(data)
+
+    def stats(self):
+        stats = self.entries.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class ScriptCacheTest(TestCase):
+    def test_contains(self):
+        from script.Script import p2pkh_script
+
+        script_pubkey = p2pkh_script(bytes(20))
+        witness_hash = bytes(range(32))
+        cache = ScriptCache(maxsize=2)
+        self.assertFalse(cache.contains(witness_hash, 0, script_pubkey, 1000))
+        cache.add(witness_hash, 0, script_pubkey, 1000)
+        self.assertTrue(cache.contains(witness_hash, 0, script_pubkey, 1000))
+        self.assertFalse(cache.contains(witness_hash, 1, script_pubkey, 1000))
+        self.assertFalse(cache.contains(witness_hash, 0, script_pubkey, 1001))
+        self.assertFalse(
+            cache.contains(witness_hash, 0, p2pkh_script(b"\x01" * 20), 1000)
+        )
+        self.assertFalse(cache.contains(bytes(32), 0, script_pubkey, 1000))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["size"], 1)
+        self.assertAlmostEqual(cache.stats()["hit_rate"], 1 / 6)
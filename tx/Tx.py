@@ -3,9 +3,23 @@ import requests
 from io import BytesIO
 from unittest.case import TestCase
 
-from script.Script import Script
+from ecc.batch import sign_batch, verify_batch
+from ecc.S256Point import S256Point
+from ecc.Signature import Signature
+from script.Script import (
+    P2PKH,
+    P2SH,
+    P2WPKH,
+    Script,
+    classify_script_pubkey,
+    p2pkh_script,
+    parse_cmds,
+)
+from script.op import SIGNATURE_CACHE
+from tx.ScriptCache import ScriptCache
 from shared.utils import (
     encode_varint,
+    hash160,
     hash256,
     int_to_little_endian,
     little_endian_to_int,
@@ -128,8 +142,13 @@ class TxOut:
         return cls(amount, script_pubkey)
 
 
+# Inputs that passed `Tx.verify_input`, shared by all transactions
+SCRIPT_CACHE_SIZE = 65536
+
+
 class Tx:
     command = b"tx"
+    script_cache = ScriptCache(SCRIPT_CACHE_SIZE)
 
     def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False, segwit=False):
         self.version = version
@@ -163,6 +182,13 @@ class Tx:
     def hash(self):
         return hash256(self.serialize_legacy())[::-1]
 
+    def wtxid(self):
+        return self.witness_hash().hex()
+
+    def witness_hash(self):
+        # Same as `hash` but committing to the witness too
+        return hash256(self.serialize())[::-1]
+
     def serialize(self):
         if self.segwit:
             return self.serialize_segwit()
@@ -279,58 +305,182 @@ class Tx:
         s += int_to_little_endian(SIGHASH_ALL, 4)
         return int.from_bytes(hash256(s), "big")
 
-    def verify_input(self, input_index):
+    def verify_input(self, input_index, witness_hash=None):
+        # Inputs found in `script_cache` passed before and are not evaluated
+        # again. Passing the bytes from `witness_hash()` as witness_hash saves
+        # serializing the transaction for every input.
+        if witness_hash is None:
+            witness_hash = self.witness_hash()
         tx_in = self.tx_ins[input_index]
         script_pubkey = tx_in.script_pubkey(testnet=self.testnet)
-        if script_pubkey.is_p2sh_script_pubkey():
-            cmd = tx_in.script_sig.cmds[-1]
-            raw_redeem = int_to_little_endian(len(cmd), 1) + cmd
-            redeem_script = Script.parse(BytesIO(raw_redeem))
-            if redeem_script.is_p2wpkh_script_pubkey():
-                z = self.sig_hash_bip143(input_index, redeem_script)
-                witness = tx_in.witness
-            elif redeem_script.is_p2wsh_script_pubkey():
-                cmd = tx_in.witness[-1]
-                raw_witness = encode_varint(len(cmd)) + cmd
-                witness_script = Script.parse(BytesIO(raw_witness))
-                z = self.sig_hash_bip143(input_index, witness_script=witness_script)
-                witness = tx_in.witness
+        amount = tx_in.value(testnet=self.testnet)
+        if self.script_cache.contains(witness_hash, input_index, script_pubkey, amount):
+            return True
+        if not self.evaluate_input(input_index):
+            return False
+        self.script_cache.add(witness_hash, input_index, script_pubkey, amount)
+        return True
+
+    def evaluate_input(self, input_index):
+        # Standard single key inputs skip the interpreter, see `single_sig_input`
+        item = self.single_sig_input(input_index)
+        if item is not None:
+            point, z, sig = item
+            return SIGNATURE_CACHE.verify(point, z, sig)
+        # Scripts are parsed lazily, malformed ones fail here instead of in
+        # `Tx.parse`
+        try:
+            tx_in = self.tx_ins[input_index]
+            script_pubkey = tx_in.script_pubkey(testnet=self.testnet)
+            if script_pubkey.is_p2sh_script_pubkey():
+                redeem_script = Script.parse_compiled(tx_in.script_sig.cmds[-1])[0]
+                if redeem_script.is_p2wpkh_script_pubkey():
+                    z = self.sig_hash_bip143(input_index, redeem_script)
+                    witness = tx_in.witness
+                elif redeem_script.is_p2wsh_script_pubkey():
+                    witness_script = Script.parse_compiled(tx_in.witness[-1])[0]
+                    z = self.sig_hash_bip143(input_index, witness_script=witness_script)
+                    witness = tx_in.witness
+                else:
+                    z = self.sig_hash(input_index, redeem_script)
+                    witness = None
             else:
-                z = self.sig_hash(input_index, redeem_script)
-                witness = None
+                if script_pubkey.is_p2wpkh_script_pubkey():
+                    z = self.sig_hash_bip143(input_index)
+                    witness = tx_in.witness
+                elif script_pubkey.is_p2wsh_script_pubkey():
+                    witness_script = Script.parse_compiled(tx_in.witness[-1])[0]
+                    z = self.sig_hash_bip143(input_index, witness_script=witness_script)
+                    witness = tx_in.witness
+                else:
+                    z = self.sig_hash(input_index)
+                    witness = None
+            combined = tx_in.script_sig + script_pubkey
+            return combined.evaluate(z, witness)
+        except SyntaxError:
+            return False
+
+    def single_sig_input(self, input_index):
+        # Returns `(point, z, sig)` when the input spends a p2pkh, p2wpkh or
+        # p2sh-p2wpkh output with a plain `<sig> <sec>` unlock whose pubkey
+        # matches the committed hash, so that the signature is all that is left
+        # to check. Anything else returns None and goes through the interpreter.
+        tx_in = self.tx_ins[input_index]
+        template, h160 = tx_in.script_pubkey(testnet=self.testnet).template()
+        try:
+            script_sig = tx_in.script_sig.cmds
+        except SyntaxError:
+            return None
+        redeem_script = None
+        if template == P2PKH:
+            unlock = script_sig
+        elif template == P2WPKH and not script_sig:
+            unlock = getattr(tx_in, "witness", None)
+        elif template == P2SH and len(script_sig) == 1 and type(script_sig[0]) == bytes:
+            redeem = script_sig[0]
+            if hash160(redeem) != h160:
+                return None
+            template, h160 = classify_script_pubkey(redeem)
+            if template != P2WPKH:
+                return None
+            redeem_script = Script.parse_compiled(redeem)[0]
+            unlock = getattr(tx_in, "witness", None)
         else:
-            if script_pubkey.is_p2wpkh_script_pubkey():
-                z = self.sig_hash_bip143(input_index)
-                witness = tx_in.witness
-            elif script_pubkey.is_p2wsh_script_pubkey():
-                cmd = tx_in.witness[-1]
-                raw_witness = encode_varint(len(cmd)) + cmd
-                witness_script = Script.parse(BytesIO(raw_witness))
-                z = self.sig_hash_bip143(input_index, witness_script=witness_script)
-                witness = tx_in.witness
-            else:
-                z = self.sig_hash(input_index)
-                witness = None
-        combined = tx_in.script_sig + script_pubkey
-        return combined.evaluate(z, witness)
+            return None
+        if unlock is None or len(unlock) != 2:
+            return None
+        der, sec = unlock
+        if type(der) != bytes or type(sec) != bytes or hash160(sec) != h160:
+            return None
+        try:
+            point = S256Point.parse(sec)
+            sig = Signature.parse(der[:-1])
+        except (ValueError, SyntaxError):
+            return None
+        if template == P2PKH:
+            z = self.sig_hash(input_index)
+        else:
+            z = self.sig_hash_bip143(input_index, redeem_script)
+        return point, z, sig
 
     def verify(self):
         if self.fee() < 0:
             return False
-        for i in range(len(self.tx_ins)):
-            if not self.verify_input(i):
+        return self.verify_inputs(range(len(self.tx_ins)))
+
+    def verify_inputs(self, input_indices):
+        # Signatures of single-key inputs are checked together in one batch,
+        # everything else is evaluated input by input. Inputs in
+        # `script_cache` are skipped altogether.
+        witness_hash = self.witness_hash()
+        spents = []
+        for i in input_indices:
+            tx_in = self.tx_ins[i]
+            spent = (
+                witness_hash,
+                i,
+                tx_in.script_pubkey(testnet=self.testnet),
+                tx_in.value(testnet=self.testnet),
+            )
+            if not self.script_cache.contains(*spent):
+                spents.append(spent)
+        remaining = self.verify_single_sig_inputs(spents)
+        if remaining is None:
+            return False
+        for spent in remaining:
+            if not self.evaluate_input(spent[1]):
                 return False
+            self.script_cache.add(*spent)
         return True
 
-    def sign_input(self, input_index, private_key):
+    def verify_single_sig_inputs(self, spents):
+        # Checks the single-key inputs among `spents`, `script_cache` keys of
+        # inputs, in one batch, see `single_sig_input`. Returns the spents
+        # that need the interpreter, or None if a signature is invalid.
+        items = []
+        batched = []
+        remaining = []
+        for spent in spents:
+            item = self.single_sig_input(spent[1])
+            if item is None:
+                remaining.append(spent)
+            elif SIGNATURE_CACHE.contains(*item):
+                self.script_cache.add(*spent)
+            else:
+                items.append(item)
+                batched.append(spent)
+        if not all(verify_batch(items)):
+            return None
+        for item, spent in zip(items, batched):
+            SIGNATURE_CACHE.add(*item)
+            self.script_cache.add(*spent)
+        return remaining
+
+    def sign_input(self, input_index, private_key, verify=True):
+        # With verify=False the signed input is not checked and True is returned
         z = self.sig_hash(input_index)
         der = private_key.sign(z).der()
         sig = der + SIGHASH_ALL.to_bytes(1, "big")
         sec = private_key.point.sec()
         script_sig = Script([sig, sec])
         self.tx_ins[input_index].script_sig = script_sig
+        if not verify:
+            return True
         return self.verify_input(input_index)
 
+    def sign_inputs(self, private_keys, processes=None, verify=True):
+        # Signs input i with private_keys[i] through `sign_batch`. The check of
+        # the signed inputs is deferred until all of them are signed and then
+        # done in one `verify_inputs` call, or skipped with verify=False.
+        jobs = [(key, self.sig_hash(i)) for i, key in enumerate(private_keys)]
+        sigs = sign_batch(jobs, processes=processes)
+        for tx_in, key, sig in zip(self.tx_ins, private_keys, sigs):
+            der = sig.der() + SIGHASH_ALL.to_bytes(1, "big")
+            tx_in.script_sig = Script([der, key.point.sec()])
+        if not verify:
+            return True
+        return self.verify_inputs(range(len(private_keys)))
+
     def is_coinbase(self):
         if len(self.tx_ins) != 1:
             return False
@@ -344,7 +494,10 @@ class Tx:
     def coinbase_height(self):
         if not self.is_coinbase():
             return None
-        first_cmd = self.tx_ins[0].script_sig.cmds[0]
+        # Only the height push has to parse, the rest of a coinbase scriptSig
+        # can be arbitrary bytes
+        raw = self.tx_ins[0].script_sig.raw_serialize()
+        first_cmd = parse_cmds(raw, limit=1)[0]
         return little_endian_to_int(first_cmd)
 
     @classmethod
@@ -518,6 +671,42 @@ class TxTest(TestCase):
         )
         self.assertTrue(tx.verify())
 
+    def test_single_sig_input(self):
+        tx = TxFetcher.fetch(
+            "452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03"
+        )
+        point, z, sig = tx.single_sig_input(0)
+        self.assertEqual(z, tx.sig_hash(0))
+        self.assertTrue(point.verify(z, sig))
+        tx = TxFetcher.fetch(
+            "46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b"
+        )
+        self.assertIsNone(tx.single_sig_input(0))
+
+    def test_script_cache(self):
+        tx = TxFetcher.fetch(
+            "46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b"
+        )
+        self.assertEqual(tx.wtxid(), tx.id())
+        Tx.script_cache.clear()
+        self.assertTrue(tx.verify())
+        self.assertEqual(Tx.script_cache.stats()["size"], len(tx.tx_ins))
+        self.assertTrue(tx.verify())
+        self.assertTrue(tx.verify_input(0))
+        self.assertTrue(tx.verify_input(0, witness_hash=tx.witness_hash()))
+        self.assertEqual(Tx.script_cache.stats()["hits"], len(tx.tx_ins) + 2)
+
+    def test_verify_malformed_script_sig(self):
+        tx = TxFetcher.fetch(
+            "452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03"
+        )
+        tx = Tx.parse(BytesIO(tx.serialize()))
+        # A push of 5 bytes with only 2 following
+        tx.tx_ins[0].script_sig = Script.parse(BytesIO(b"\x03\x05ab"))
+        self.assertIsNone(tx.single_sig_input(0))
+        self.assertFalse(tx.verify_input(0))
+        self.assertFalse(tx.verify())
+
     def test_verify_p2sh(self):
         tx = TxFetcher.fetch(
             "46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b"
@@ -552,6 +741,8 @@ class TxTest(TestCase):
         self.assertTrue(tx.verify())
 
     def test_sign_input(self):
+        from ecc.PrivateKey import PrivateKey
+
         private_key = PrivateKey(secret=8675309)
         stream = BytesIO(
             bytes.fromhex(
@@ -563,6 +754,22 @@ class TxTest(TestCase):
         want = "010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d0000006b4830450221008ed46aa2cf12d6d81065bfabe903670165b538f65ee9a3385e6327d80c66d3b502203124f804410527497329ec4715e18558082d489b218677bd029e7fa306a72236012103935581e52c354cd2f484fe8ed83af7a3097005b2f9c60bff71d35bd795f54b67ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000"
         self.assertEqual(tx_obj.serialize().hex(), want)
 
+    def test_sign_inputs(self):
+        from ecc.PrivateKey import PrivateKey
+
+        private_key = PrivateKey(secret=8675309)
+        raw_tx = bytes.fromhex(
+            "010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000"
+        )
+        want = Tx.parse(BytesIO(raw_tx), testnet=True)
+        want.sign_input(0, private_key)
+        tx_obj = Tx.parse(BytesIO(raw_tx), testnet=True)
+        self.assertTrue(tx_obj.sign_inputs([private_key]))
+        self.assertEqual(tx_obj.serialize(), want.serialize())
+        tx_obj = Tx.parse(BytesIO(raw_tx), testnet=True)
+        self.assertTrue(tx_obj.sign_inputs([private_key], processes=2, verify=False))
+        self.assertEqual(tx_obj.serialize(), want.serialize())
+
     def test_is_coinbase(self):
         raw_tx = bytes.fromhex(
             "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000"
@@ -578,6 +785,9 @@ class TxTest(TestCase):
         stream = BytesIO(raw_tx)
         tx = Tx.parse(stream)
         self.assertEqual(tx.coinbase_height(), 465879)
+        # Height push followed by a truncated push
+        tx.tx_ins[0].script_sig = Script.parse(BytesIO(bytes.fromhex("0503d71b0705")))
+        self.assertEqual(tx.coinbase_height(), 465879)
         raw_tx = bytes.fromhex(
             "0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600"
         )